@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Benchmarks pattern searches on synthetic trees of different shapes and
+sizes, and reports time, peak memory and the per-phase times and counters of
+every search (see SearchStats) as JSON, so results from different versions can
+be compared.
+
+Examples:
+
+    python benchmarks/bench_treematcher.py --sizes 100 1000 10000 -o before.json
+    python benchmarks/bench_treematcher.py --sizes 100 1000 10000 --compare before.json
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import random
+import platform
+import time
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from itertools import islice
+from timeit import default_timer as timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import ete3
+from ete3 import PhyloTree
+
+# benchmark the treematcher of this checkout
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from treematcher.treematcher import (TreePattern, CompiledPattern, TreePatternCache,
+                                     SearchStats, find_matches)
+
+# Leaves are named as <species>_<gene> (e.g. S07_1)
+N_SPECIES = 10
+N_GENES = 2
+
+# Pattern shapes searched in every tree. Node names are repeated across the
+# tree, so all of them are expected to find some matches in random trees.
+PATTERNS = OrderedDict([
+    ("strict", "(S00_1, S01_1);"),
+    ("strict_nested", "((S00_1, '@.species == \"S01\"'), '@.species in (\"S02\", \"S03\")');"),
+    ("one_or_more", "('@.species == \"S01\"+', S00_1);"),
+    ("zero_or_more", "('@.species == \"S01\"*', '@.species == \"S00\"');"),
+    ("min_max", "('@.species == \"S01\"{1,3}', '@.species == \"S02\"');"),
+    ("loose", "(S00_1, S01_1)^;"),
+    ("loose_nested", "((S00_1, S01_1)^, S02_1)^;"),
+    ("attributes", "('@.dist > 0.5', '@.dist < 0.1')'@.support > 0.5';"),
+    ("syntax", "((S00_1, '@.species != \"S00\"')'n_species(@) == 2', S01_1)'n_leaves(@) < 5';"),
+])
+
+
+def _name_leaves(tree, rng):
+    for node in tree.traverse():
+        if node.children:
+            node.support = round(rng.random(), 3)
+        else:
+            node.name = "S%02d_%d" % (rng.randrange(N_SPECIES), rng.randrange(N_GENES))
+        node.dist = round(rng.random(), 3)
+    tree.set_species_naming_function(lambda name: name.split("_")[0])
+    return tree
+
+def make_random_tree(n_leaves, rng):
+    """ Random binary tree, built by joining random pairs of subtrees. """
+    nodes = [PhyloTree() for _ in range(n_leaves)]
+    while len(nodes) > 1:
+        i = rng.randrange(len(nodes))
+        nodes[i], nodes[-1] = nodes[-1], nodes[i]
+        j = rng.randrange(len(nodes) - 1)
+        parent = PhyloTree()
+        parent.add_child(nodes.pop())
+        parent.add_child(nodes[j])
+        nodes[j] = parent
+    return _name_leaves(nodes[0], rng)
+
+def make_caterpillar_tree(n_leaves, rng):
+    """ Binary tree in which every internal node has a leaf child. """
+    root = node = PhyloTree()
+    for _ in range(n_leaves - 2):
+        node.add_child()
+        node = node.add_child()
+    if n_leaves > 1:
+        node.add_child()
+        node.add_child()
+    return _name_leaves(root, rng)
+
+def make_balanced_tree(n_leaves, rng):
+    """ Binary tree of minimum depth. """
+    nodes = [PhyloTree() for _ in range(n_leaves)]
+    while len(nodes) > 1:
+        parents = []
+        for i in range(0, len(nodes) - 1, 2):
+            parent = PhyloTree()
+            parent.add_child(nodes[i])
+            parent.add_child(nodes[i + 1])
+            parents.append(parent)
+        if len(nodes) % 2:
+            parents.append(nodes[-1])
+        nodes = parents
+    return _name_leaves(nodes[0], rng)
+
+def make_polytomy_tree(n_leaves, rng, max_children=10):
+    """ Random tree in which internal nodes have between 2 and max_children
+    children. """
+    nodes = [PhyloTree() for _ in range(n_leaves)]
+    while len(nodes) > 1:
+        parent = PhyloTree()
+        for _ in range(min(len(nodes), rng.randint(2, max_children))):
+            i = rng.randrange(len(nodes))
+            nodes[i], nodes[-1] = nodes[-1], nodes[i]
+            parent.add_child(nodes.pop())
+        nodes.append(parent)
+    return _name_leaves(nodes[0], rng)
+
+SHAPES = OrderedDict([
+    ("random", make_random_tree),
+    ("caterpillar", make_caterpillar_tree),
+    ("balanced", make_balanced_tree),
+    ("polytomy", make_polytomy_tree),
+])
+
+
+def run_search(tree, newick, match_limit=None):
+    """ Searches a pattern in a tree with find_matches, recording the time and
+    counters of every phase in a SearchStats instance. Constraints are
+    evaluated lazily, so part of their cost is reported within the search
+    phase (see SearchStats).
+
+    :return: the number of matches found (up to match_limit), a dictionary
+        with the time in seconds of every phase and a dictionary with the
+        counters of the search.
+    """
+    start = timer()
+    pattern = CompiledPattern(TreePattern(newick, quoted_node_names=True))
+    compile_time = timer() - start
+
+    stats = SearchStats()
+    start = timer()
+    cache = TreePatternCache(tree)
+    matches = find_matches(tree, pattern, cache, stats=stats)
+    n_matches = sum(1 for _ in islice(matches, match_limit))
+    matches.close()
+    search_time = timer() - start
+
+    times = OrderedDict([("compile", compile_time)])
+    times.update(stats.times)
+    times["total"] = compile_time + search_time
+    counters = OrderedDict([
+        ("rejected", stats.rejected),
+        ("candidates", sum(stats.candidates.values())),
+        ("evaluations", stats.evaluations),
+        ("combinations", stats.combinations),
+        ("products", stats.products),
+        ("lca_calls", stats.lca_calls),
+    ])
+    return n_matches, times, counters
+
+def measure_peak_memory(tree, newick, match_limit=None):
+    """ Returns the peak memory in bytes allocated during a search, or None if
+    it cannot be measured (python < 3.4). """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        run_search(tree, newick, match_limit)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    results = []
+    for shape in args.shapes:
+        for size in args.sizes:
+            start = timer()
+            tree = SHAPES[shape](size, rng)
+            build_time = timer() - start
+            n_nodes = sum(1 for _ in tree.traverse())
+            for name in args.patterns:
+                newick = PATTERNS[name]
+                # best of several repetitions, each one with a new cache
+                runs = [run_search(tree, newick, args.match_limit)
+                        for _ in range(args.repeat)]
+                n_matches = runs[0][0]
+                times = OrderedDict((phase, min(r[1][phase] for r in runs))
+                                    for phase in runs[0][1])
+                result = OrderedDict([
+                    ("shape", shape), ("leaves", size), ("nodes", n_nodes),
+                    ("pattern", name), ("newick", newick),
+                    ("matches", n_matches),
+                    ("truncated", args.match_limit is not None and n_matches >= args.match_limit),
+                    ("tree_build_time", build_time),
+                    ("times", times),
+                ("counters", runs[0][2]),
+                    ("peak_memory", None if args.no_memory else
+                     measure_peak_memory(tree, newick, args.match_limit)),
+                ])
+                results.append(result)
+                if not args.quiet:
+                    print("%-12s %8d %-14s %8d matches %10.4fs" %
+                          (shape, size, name, n_matches, times["total"]), file=sys.stderr)
+    return results
+
+def compare_results(results, baseline, threshold):
+    """ Returns the cases whose total time grew more than threshold (a
+    fraction) with respect to the baseline results. """
+    case = lambda r: (r["shape"], r["leaves"], r["pattern"])
+    previous = dict((case(r), r) for r in baseline["results"])
+    regressions = []
+    for result in results:
+        old = previous.get(case(result))
+        if old is None:
+            continue
+        old_time, new_time = old["times"]["total"], result["times"]["total"]
+        if new_time > old_time * (1 + threshold) and new_time - old_time > 1e-3:
+            regressions.append((case(result), old_time, new_time))
+    return regressions
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="number of leaves of the trees (up to 10^6)")
+    parser.add_argument("--shapes", nargs="+", choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument("--patterns", nargs="+", choices=list(PATTERNS), default=list(PATTERNS))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="repetitions of every search; the fastest one is reported")
+    parser.add_argument("--match_limit", type=int, default=10000,
+                        help="stop every search after this number of matches")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no_memory", action="store_true",
+                        help="do not measure peak memory (saves one search per case)")
+    parser.add_argument("-o", "--output", help="JSON file for the results (default: stdout)")
+    parser.add_argument("--compare", help="JSON file with previous results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown (as a fraction) reported as a regression")
+    parser.add_argument("-q", "--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    report = OrderedDict([
+        ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("ete3", getattr(ete3, "__version__", None)),
+        ("seed", args.seed),
+        ("results", run_benchmarks(args)),
+    ])
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare_results(report["results"], json.load(baseline),
+                                          args.threshold)
+        for (shape, size, name), old_time, new_time in regressions:
+            print("REGRESSION %s %d %s: %.4fs -> %.4fs" % (shape, size, name, old_time, new_time),
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
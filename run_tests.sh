@@ -1 +1,2 @@
 python -m treematcher.test.test_treematcher
+python -m treematcher.test.test_ete_search
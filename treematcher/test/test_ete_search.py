@@ -0,0 +1,172 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from argparse import ArgumentParser
+
+import six
+
+from treematcher.tools import ete_search
+
+TREES = ["((Hsa_1,Mmu_1),(Hsa_1,Ptr_1));",
+         "(((Hsa_1,Mmu_1),Dme_1),((Hsa_1,Mmu_1),Ptr_2));",
+         "((Hsa_2,Mmu_1),Dme_1);",
+         "(Hsa_1,Mmu_1);"]
+
+
+def parse_args(argv):
+    parser = ArgumentParser()
+    ete_search.populate_args(parser)
+    return parser.parse_args(argv)
+
+
+class Test_newick_records(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content, compressed=False):
+        path = os.path.join(self.tmpdir, name)
+        handle = gzip.open(path, 'wb') if compressed else open(path, 'wb')
+        with handle:
+            handle.write(content)
+        return path
+
+    def test_records(self):
+        content = (b"(a,b)[&&NHX:note=x;y];\n((c,\n d),e);;\n"
+                   b"  (f,[comment]g);\n(h,i)")
+        expected = ["(a,b)[&&NHX:note=x;y];", "((c,\n d),e);", "(f,[comment]g);",
+                    "(h,i)"]
+        plain = self.write("trees.nw", content)
+        compressed = self.write("trees.nw.gz", content, compressed=True)
+        for chunk_size in list(range(1, len(content) + 2)) + [1 << 20]:
+            for path, use_mmap in [(plain, False), (plain, True), (compressed, False)]:
+                records = list(ete_search.newick_record_iterator(
+                    path, use_mmap=use_mmap, chunk_size=chunk_size))
+                self.assertEqual(records, expected, (chunk_size, path, use_mmap))
+
+    def test_empty_file(self):
+        path = self.write("empty.nw", b"")
+        for use_mmap in [False, True]:
+            self.assertEqual(list(ete_search.newick_record_iterator(path, use_mmap)), [])
+
+
+class Test_search(unittest.TestCase):
+    def run_search(self, argv, patterns):
+        args = parse_args(argv)
+        stdout = ete_search.sys.stdout
+        ete_search.sys.stdout = output = six.StringIO()
+        try:
+            all_stats = ete_search.run_search(args, patterns)
+        finally:
+            ete_search.sys.stdout = stdout
+        return output.getvalue(), [(s.matched, s.not_matched, s.errors) for s in all_stats]
+
+    def test_parallel_search(self):
+        trees = TREES * 5 + ["((a,b);"]
+        patterns = ["(Hsa_1, Mmu_1);", "(Hsa_1, Mmu_1)^;"]
+        serial = self.run_search(["-t"] + trees + ["--count"], patterns)
+        self.assertEqual(serial[1], [(15, 5, 1), (15, 5, 1)])
+        parallel = self.run_search(["-t"] + trees + ["--count", "--cpu", "2",
+                                                     "--chunk_size", "2"], patterns)
+        self.assertEqual(parallel, serial)
+
+        # the matches within a tree are not reported in any particular order
+        for options in [["--count", "--unordered"], [], ["--unordered"]]:
+            serial = self.run_search(["-t"] + trees + options, patterns)
+            parallel = self.run_search(["-t"] + trees + options +
+                                       ["--cpu", "2", "--chunk_size", "1"], patterns)
+            self.assertEqual(sorted(parallel[0].splitlines()),
+                             sorted(serial[0].splitlines()))
+            self.assertEqual(parallel[1], serial[1])
+
+    def test_output_by_pattern(self):
+        # the matches of every pattern are reported in a block of its own
+        patterns = ["(Hsa_1, Mmu_1);", "(Hsa_1, Ptr_1);"]
+        output, stats = self.run_search(["-t"] + TREES[:2] + ["--count", "-v", "3"],
+                                        patterns)
+        lines = output.splitlines()
+        start = lines.index("match(es) for pattern_0:")
+        self.assertEqual(lines[start:], ["match(es) for pattern_0:", "1", "2",
+                                         "match(es) for pattern_1:", "1", "0"])
+        self.assertEqual(stats, [(2, 0, 0), (1, 1, 0)])
+
+
+class Test_tree_cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "trees.nw")
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load_trees(self):
+        args = parse_args(["--target_tree_list", self.path, "--tree_cache", self.cache_dir])
+        trees = []
+        for cached in ete_search.cached_tree_iterator(args):
+            try:
+                trees.append(cached.load().tree.write(format=9))
+            except ValueError:
+                trees.append(None)
+        return trees
+
+    def test_tree_cache(self):
+        with open(self.path, "w") as handle:
+            handle.write("\n".join(TREES[:2] + ["((a,b);"]))
+        expected = ["((Hsa_1,Mmu_1),(Hsa_1,Ptr_1));",
+                    "(((Hsa_1,Mmu_1),Dme_1),((Hsa_1,Mmu_1),Ptr_2));", None]
+        self.assertEqual(self.load_trees(), expected)
+        args = parse_args(["--target_tree_list", self.path, "--tree_cache", self.cache_dir])
+        cache_path = ete_search.tree_cache_path(args)
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(cache_path)])
+        header = ete_search.read_tree_cache_header(cache_path)
+        self.assertEqual(header["source"], ete_search.file_digest(self.path))
+        self.assertEqual(self.load_trees(), expected)
+
+        # the cache is rebuilt when the source file changes
+        with open(self.path, "w") as handle:
+            handle.write(TREES[3])
+        self.assertEqual(self.load_trees(), ["(Hsa_1,Mmu_1);"])
+        self.assertNotEqual(ete_search.read_tree_cache_header(cache_path), header)
+
+        # and when it is not a tree cache
+        with open(cache_path, "wb") as handle:
+            handle.write(b"garbage")
+        self.assertEqual(ete_search.read_tree_cache_header(cache_path), None)
+        self.assertEqual(self.load_trees(), ["(Hsa_1,Mmu_1);"])
+
+    def test_same_file_names(self):
+        # tree lists with the same name in different directories do not
+        # overwrite the cache of each other
+        other_dir = os.path.join(self.tmpdir, "other")
+        os.makedirs(other_dir)
+        other_path = os.path.join(other_dir, "trees.nw")
+        with open(self.path, "w") as handle:
+            handle.write(TREES[3])
+        with open(other_path, "w") as handle:
+            handle.write(TREES[2])
+        self.assertEqual(self.load_trees(), ["(Hsa_1,Mmu_1);"])
+        self.path = other_path
+        self.assertEqual(self.load_trees(), ["((Hsa_2,Mmu_1),Dme_1);"])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        # relative and absolute paths of a file share the cache
+        cwd = os.getcwd()
+        os.chdir(other_dir)
+        try:
+            args = parse_args(["--target_tree_list", "trees.nw",
+                               "--tree_cache", self.cache_dir])
+            self.assertEqual(ete_search.tree_cache_path(args),
+                             ete_search.tree_cache_path(parse_args(
+                                 ["--target_tree_list", other_path,
+                                  "--tree_cache", self.cache_dir])))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    unittest.main()
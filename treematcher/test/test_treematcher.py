@@ -1,7 +1,19 @@
 import unittest
-from ete3 import  Tree
-from treematcher.treematcher import TreePattern
+from ete3 import  Tree, PhyloTree
+from treematcher.treematcher import (TreePattern, PatternSyntax, TreePatternCache,
+                                     plan_constraint, assign_children,
+                                     compute_match_matrix, children_match,
+                                     PatternSet, LCAIndex,
+                                     vectorize_constraint, SearchStats,
+                                     SearchBudget, SearchBudgetExceeded,
+                                     load_tree_cache, MatchSession,
+                                     compile_constraint, _LRUCache)
+from treematcher import treematcher as tm
+import itertools
+import pickle
+import time
 from copy import deepcopy
+from collections import defaultdict
 #class Test_strict_match():
 class Test_strict_match(unittest.TestCase):
 
@@ -320,5 +332,575 @@ class Test_basic_tests(unittest.TestCase):
         self.assertTrue(test)
 
 
+class Test_constraint_compilation(unittest.TestCase):
+    def test_plain_names_and_expressions(self):
+        tree = Tree("((a, b)c, (a, d));", format=1)
+        p1 = TreePattern("(a, b)c ;", format=1)
+        tree2 = Tree("((a, b), (a, d));", format=1)
+        p2 = TreePattern(""" ('@.name == "a"', '@.name in ("b", "d")'); """,
+                         quoted_node_names=True)
+        self.assertEqual(len(list(p1.find_match(tree))), 1)
+        self.assertEqual(len(list(p2.find_match(tree))), 1)
+        self.assertEqual(len(list(p2.find_match(tree2))), 2)
+
+    def test_custom_syntax_in_children(self):
+        class CustomSyntax(PatternSyntax):
+            def is_vowel(self, target_node):
+                return target_node.name in "aeiou"
+
+        tree = Tree("((a, b), (a, e));")
+        pattern = TreePattern(""" ('is_vowel(@)', 'is_vowel(@)'); """,
+                              quoted_node_names=True, syntax=CustomSyntax())
+        self.assertEqual(list(pattern.find_match(tree)), [(tree&'e').up])
+
+    def test_code_cache_is_bounded(self):
+        cache = _LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        # 'b' was the least recently used key
+        self.assertFalse('b' in cache)
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+
+        code = compile_constraint('1 + 1')
+        self.assertTrue(compile_constraint('1 + 1') is code)
+        for i in range(tm._CONSTRAINT_CODE_CACHE.maxsize + 1):
+            compile_constraint('%d + 1' % i)
+        self.assertEqual(len(tm._CONSTRAINT_CODE_CACHE),
+                         tm._CONSTRAINT_CODE_CACHE.maxsize)
+
+
+class Test_indexed_constraints(unittest.TestCase):
+    def test_plan_constraint(self):
+        lookups, exact = plan_constraint('(__target_node.name == "a") and not __target_node.children')
+        self.assertEqual(lookups, [('eq', 'name', 'a'), ('leaf', True)])
+        self.assertTrue(exact)
+
+        lookups, exact = plan_constraint('(0.5 < __target_node.dist and len(__target_node.children) == 2) and __target_node.children')
+        self.assertEqual(lookups, [('cmp', 'dist', '>', 0.5), ('leaf', False)])
+        self.assertFalse(exact)
+
+    def test_indexed_and_evaluated_matches(self):
+        tree = Tree("((a:0.1, b:0.6)c:0.5, (a:0.7, d:0.3)e:0.2, f:0.9);", format=1)
+        cache = TreePatternCache(tree)
+        expressions = ['@.name in ("a", "d")', '@.dist >= 0.5', '@.dist != 0.1',
+                       'not @.is_leaf()', '@.dist > 0.2 and len(@.name) == 1']
+
+        for exp in expressions:
+            for nw in ["('%s');" %exp, "(('%s'), f);" %exp]:
+                pattern = TreePattern(nw, quoted_node_names=True)
+                for pnode in pattern.traverse():
+                    pnode.init_controller()
+                    expected = set(n for n in tree.traverse()
+                                   if pnode.is_local_match(n, None))
+                    self.assertEqual(pnode.find_local_matches(cache), expected)
+
+
+class Test_children_assignment(unittest.TestCase):
+    def test_assign_children(self):
+        # two target children, both able to match any of the two pattern nodes
+        self.assertTrue(assign_children([[0, 1], [0, 1]], [1, 1], [1, 1]))
+        # the first pattern node needs two nodes, but only one can match it
+        self.assertFalse(assign_children([[0, 1], [1]], [2, 0], [2, 5]))
+        # max occurrences prevent consuming the third target child
+        self.assertFalse(assign_children([[0], [0], [0, 1]], [1, 0], [2, 0]))
+        self.assertTrue(assign_children([[0], [0], [0, 1]], [1, 0], [2, 1]))
+
+    def test_large_polytomy(self):
+        leaves = ["a"] * 15 + ["b"] * 10 + ["c"] * 10
+        tree = Tree("((%s), (a, b));" %(", ".join(leaves)))
+        p1 = TreePattern(" ('a{10,20}', 'b+', 'c*', 'd*') ;")
+        p2 = TreePattern(" ('a{10,20}', 'b{1,9}', 'c*') ;")
+        p3 = TreePattern(" ('a+', 'a+', 'b*', 'c*') ;")
+        self.assertEqual(list(p1.find_match(tree)), [(tree&'c').up])
+        self.assertEqual(list(p2.find_match(tree)), [])
+        self.assertEqual(list(p3.find_match(tree)), [(tree&'c').up])
+
+    def test_memoized_children_match(self):
+        tree = Tree("(((a, b), (a, b)), ((a, b), c));")
+        pattern = TreePattern("((a, b)+, c*);")
+        for pnode in pattern.traverse():
+            pnode.init_controller()
+        c2nodes = compute_match_matrix(pattern, tree)
+
+        memo = {}
+        for tnode in tree.traverse():
+            expected = children_match(tnode, pattern, c2nodes)
+            self.assertEqual(children_match(tnode, pattern, c2nodes, memo=memo),
+                             expected)
+        self.assertFalse(memo[(tree, pattern)])
+        self.assertTrue(memo[(tree.children[0], pattern)])
+        self.assertTrue(memo[(tree.children[1], pattern)])
+
+
+class Test_pattern_cache(unittest.TestCase):
+    def test_shared_cache(self):
+        tree = PhyloTree("((Hsa_1, Mmu_1), (Hsa_2, (Mmu_2, Ptr_1)));")
+        cache = TreePatternCache(tree)
+        p1 = TreePattern(""" (Hsa_2, (Mmu_2, Ptr_1)'n_species(@) == 2')'n_leaves(@) == 3'; """,
+                         quoted_node_names=True)
+        p2 = TreePattern(""" ((Mmu_2, Ptr_1)'contains_species(@, ["Mmu", "Ptr"])', Hsa_2); """,
+                         quoted_node_names=True)
+
+        expected = [(tree&'Hsa_2').up]
+        self.assertEqual(list(p1.find_match(tree, cache)), expected)
+        self.assertEqual(list(p2.find_match(tree, cache)), expected)
+        # subtree content was computed once, and it is kept in the cache
+        self.assertTrue(cache._aggregates is not None)
+        self.assertEqual(list(p1.find_match(tree)), expected)
+
+        other = PhyloTree("((Hsa_1, Mmu_1), Ptr_1);")
+        self.assertRaises(ValueError, list, p1.find_match(other, cache))
+
+    def test_subtree_aggregates(self):
+        tree = PhyloTree("(((Hsa_1, Hsa_2), Mmu_1), ((Hsa_3, Ptr_1), (Mmu_2, Dme_1)));")
+        tree.get_descendant_evol_events()
+        syntax = PatternSyntax()
+        functions = [syntax.n_leaves, syntax.n_species, syntax.species,
+                     syntax.n_duplications, syntax.n_speciations]
+
+        expected = [[f(n) for f in functions] for n in tree.traverse()]
+        syntax.cache = TreePatternCache(tree)
+        observed = [[f(n) for f in functions] for n in tree.traverse()]
+        self.assertEqual(observed, expected)
+
+        self.assertEqual(syntax.n_duplications(tree), 2)
+        self.assertTrue(syntax.contains_species(tree.children[0], "Hsa"))
+        self.assertTrue(syntax.contains_species(tree, ["Dme", "Hsa"]))
+        self.assertFalse(syntax.contains_species(tree.children[0], ["Hsa", "Dme"]))
+        self.assertFalse(syntax.contains_species(tree, ["Hsa", "Xla"]))
+
+        # species are encoded as bits
+        cache = syntax.cache
+        self.assertEqual(sorted(cache.species2id), ["Dme", "Hsa", "Mmu", "Ptr"])
+        mask = cache.get_species_mask(tree.children[0])
+        self.assertEqual(mask, (1 << cache.species2id["Hsa"]) | (1 << cache.species2id["Mmu"]))
+        self.assertTrue(cache.get_species(tree&'Hsa_1') is
+                        cache.get_species((tree&'Hsa_1').up))
+
+
+class Test_compiled_pattern(unittest.TestCase):
+    def test_reuse_compiled_pattern(self):
+        pattern = TreePattern("((a, b)^, (c+, d)^);")
+        original = pattern.write(format=9)
+        compiled = pattern.compile()
+
+        # a, b, c+, d and the root are matched independently
+        self.assertEqual(len(compiled.subpatterns), 5)
+        self.assertEqual(len(compiled.expected_groups), 3)
+
+        t1 = Tree("(((a, x), b), (c, (c, (d, y))));")
+        t2 = Tree("(((a, b), x), ((c, e), y));")
+        for _ in range(2):
+            self.assertEqual(set(compiled.find_match(t1)), set([t1]))
+            self.assertEqual(list(compiled.find_match(t2)), [])
+
+        # the original pattern is neither modified nor copied
+        self.assertEqual(pattern.write(format=9), original)
+        self.assertFalse(hasattr(pattern, "constraint"))
+
+    def test_compiled_pattern_syntax(self):
+        syntax = PatternSyntax()
+        tree = PhyloTree("((Hsa_1, Mmu_1), (Hsa_2, Ptr_1));")
+        pattern = TreePattern(""" ('Hsa_1', 'n_species(@) == 1')'n_leaves(@) == 2'; """,
+                              quoted_node_names=True, syntax=syntax)
+        compiled = pattern.compile()
+        self.assertEqual(list(compiled.find_match(tree)), [(tree&'Hsa_1').up])
+        # the cache was attached only to the copies of the syntax used by
+        # the compiled pattern during the search
+        self.assertTrue(syntax.cache is not None)
+        self.assertFalse(isinstance(syntax.cache, TreePatternCache))
+        for copied_syntax in compiled.syntaxes:
+            self.assertFalse(isinstance(copied_syntax.cache, TreePatternCache))
+
+    def test_interleaved_searches(self):
+        t1 = PhyloTree("((Hsa_1, Mmu_1), (Hsa_2, Ptr_1));")
+        t2 = PhyloTree("(((Hsa_1, Mmu_1), Dme_1), (Ptr_1, Dme_2));")
+        compiled = TreePattern("('n_leaves(@) == 1', 'n_species(@) == 1');",
+                               quoted_node_names=True).compile()
+        expected = [list(compiled.find_match(t)) for t in (t1, t2)]
+        self.assertEqual([len(matches) for matches in expected], [2, 2])
+
+        # every search keeps the cache of its own tree
+        searches = [compiled.find_match(t1), compiled.find_match(t2)]
+        found = list(zip(*searches))
+        self.assertEqual([list(s) for s in searches], [[], []])
+        self.assertEqual(list(zip(*found)), [tuple(matches) for matches in expected])
+
+        pattern_set = PatternSet([compiled])
+        searches = [pattern_set.find_matches(t1), pattern_set.find_matches(t2)]
+        self.assertEqual([next(s) for s in searches], [(0, expected[0][0]), (0, expected[1][0])])
+        self.assertEqual([list(s) for s in searches],
+                         [[(0, m) for m in e[1:]] for e in expected])
+
+
+class Test_pattern_set(unittest.TestCase):
+    def test_pattern_set(self):
+        tree = Tree("(((a, b), (c, d)), ((a, b), e));")
+        patterns = [TreePattern("(a, b);"),
+                    TreePattern("((a, b), (c, d));"),
+                    TreePattern("('@.name in (\"d\", \"e\")', '@.children')^;",
+                                quoted_node_names=True),
+                    TreePattern("(a, x);")]
+        pattern_set = PatternSet(patterns)
+
+        # constraints shared by patterns are evaluated only once
+        self.assertEqual(len(pattern_set.key2node), 8)
+
+        found = defaultdict(list)
+        for i, match in pattern_set.find_matches(tree):
+            found[i].append(match)
+        for i, pattern in enumerate(patterns):
+            self.assertEqual(sorted(found[i], key=id),
+                             sorted(pattern.find_match(tree), key=id))
+        self.assertEqual(len(found[0]), 2)
+        self.assertEqual(len(found[3]), 0)
+
+
+class Test_query_modes(unittest.TestCase):
+    def test_exists_and_count(self):
+        tree = Tree("(((a, b), (c, d)), ((a, b), e));")
+        self.assertTrue(TreePattern("(a, b);").exists(tree))
+        self.assertEqual(TreePattern("(a, b);").count(tree), 2)
+        self.assertFalse(TreePattern("(a, x);").exists(tree))
+        self.assertEqual(TreePattern("(a, x);").count(tree), 0)
+        loose = TreePattern("((a, b)^, e);").compile()
+        self.assertEqual(loose.count(tree), len(list(loose.find_match(tree))))
+
+        pattern_set = PatternSet([TreePattern("(a, b);"), TreePattern("(a, x);")])
+        self.assertEqual(pattern_set.exists(tree), [True, False])
+        self.assertEqual(pattern_set.count(tree), [2, 0])
+
+    def test_lazy_search(self):
+        class CountingSyntax(PatternSyntax):
+            calls = 0
+            def check(self, target_node):
+                CountingSyntax.calls += 1
+                return True
+
+        tree = Tree()
+        tree.populate(200)
+        pattern = TreePattern("('check(@)', 'check(@)');", quoted_node_names=True,
+                              syntax=CountingSyntax())
+        # stopping at the first match does not evaluate all the constraints
+        next(pattern.find_match(tree))
+        self.assertTrue(0 < CountingSyntax.calls < 20)
+        self.assertTrue(pattern.exists(tree))
+
+        loose = TreePattern("(('check(@)')^, 'check(@)');", quoted_node_names=True,
+                            syntax=CountingSyntax())
+        CountingSyntax.calls = 0
+        next(loose.find_match(tree))
+        self.assertTrue(0 < CountingSyntax.calls < 50)
+
+    def test_missing_required_node(self):
+        class FailingSyntax(PatternSyntax):
+            def fail(self, target_node):
+                raise AssertionError("constraint should not be evaluated")
+
+        tree = Tree("((a, b), (c, d));")
+        # x is not in the tree, so the other constraints are not evaluated
+        pattern = TreePattern("('fail(@)', x);", quoted_node_names=True,
+                              syntax=FailingSyntax())
+        self.assertFalse(pattern.exists(tree))
+        self.assertEqual(list(pattern.find_match(tree)), [])
+
+        # optional nodes are not required to be present
+        pattern = TreePattern("(a, b, 'x{0,1}');", quoted_node_names=True)
+        self.assertEqual(pattern.count(tree), 1)
+
+
+class Test_pattern_signature(unittest.TestCase):
+    def test_signature(self):
+        pattern = TreePattern(""" ('contains_species(@, ["Hsa", "Mmu"])', Ptr_1, 'x{0,1}')'n_leaves(@) > 3'; """,
+                              quoted_node_names=True).compile()
+        signature = pattern.signature
+        self.assertEqual(signature.names, set(["Ptr_1"]))
+        self.assertEqual(signature.species, set(["Hsa", "Mmu"]))
+        self.assertEqual(signature.min_leaves, 4)
+
+        t1 = PhyloTree("(((Hsa_1, Mmu_1), Hsa_2), Ptr_1);")
+        t2 = PhyloTree("(((Hsa_1, Ptr_2), Hsa_2), Ptr_1);")
+        t3 = PhyloTree("((Hsa_1, Mmu_1), Ptr_1);")
+        self.assertTrue(signature.may_match(TreePatternCache(t1)))
+        self.assertFalse(signature.may_match(TreePatternCache(t2)))
+        self.assertFalse(signature.may_match(TreePatternCache(t3)))
+
+    def test_rejected_trees(self):
+        class CountingSyntax(PatternSyntax):
+            calls = 0
+            def count(self, target_node):
+                CountingSyntax.calls += 1
+                return True
+
+        pattern = TreePattern("(('count(@)', Hsa_1)^, Mmu_1);", quoted_node_names=True,
+                              syntax=CountingSyntax())
+        tree = PhyloTree("((Hsa_1, Ptr_1), (Hsa_2, Ptr_2));")
+        pattern_set = PatternSet([pattern])
+        self.assertEqual(pattern_set.count(tree), [0])
+        self.assertEqual(pattern.count(tree), 0)
+        self.assertEqual(CountingSyntax.calls, 0)
+
+
+class Test_loose_join(unittest.TestCase):
+    def test_lca_index(self):
+        tree = Tree("(((a, b)x, (c, d)y)z, ((e, f)w, g)v)r;", format=1)
+        lca_index = LCAIndex(tree)
+        nodes = list(tree.traverse())
+        for n1 in nodes:
+            for n2 in nodes:
+                if n1 is not n2:
+                    self.assertTrue(lca_index.get_common_ancestor([n1, n2]) is
+                                    tree.get_common_ancestor([n1, n2]))
+        self.assertEqual(lca_index.get_common_ancestor([tree&'a', tree&'b', tree&'c']).name, 'z')
+
+    def test_ancestry(self):
+        tree = Tree("(((a, b)x, (c, d)y)z, ((e, f)w, g)v)r;", format=1)
+        lca_index = LCAIndex(tree)
+        for n1 in tree.traverse():
+            ancestors = set([n1] + n1.get_ancestors())
+            for n2 in tree.traverse():
+                self.assertEqual(lca_index.is_ancestor(n2, n1), n2 in ancestors)
+        self.assertEqual(lca_index.get_depth(tree&'e'), 3)
+        # the common ancestor table is only built when first needed
+        self.assertTrue(lca_index._sparse is None)
+        self.assertEqual(lca_index.get_common_ancestor([tree&'a', tree&'e']), tree)
+        self.assertTrue(lca_index._sparse is not None)
+
+        # also available to constraints, with or without a cache
+        syntax = PatternSyntax()
+        a, y = tree&'a', tree&'y'
+        self.assertTrue(syntax.is_ancestor(tree&'z', a))
+        self.assertFalse(syntax.is_ancestor(y, a))
+        self.assertEqual(syntax.common_ancestor(a, tree&'c').name, 'z')
+        syntax.cache = TreePatternCache(tree)
+        self.assertFalse(syntax.is_ancestor(y, a))
+        self.assertEqual(syntax.common_ancestor(a, tree&'c').name, 'z')
+
+        pattern = TreePattern(""" ('is_ancestor(@.get_tree_root()&"y", @)', 'common_ancestor(@, @.get_tree_root()&"a").name == "z"')'@.children'; """,
+                              quoted_node_names=True)
+        self.assertEqual(list(pattern.find_match(tree)), [tree&'y'])
+
+    def test_join_order(self):
+        tree = Tree("(((a, b), (a, (b, d))), c);")
+        pattern = TreePattern("((a, b)^, c);")
+        matches = list(pattern.find_match(tree))
+
+        # same matches, in the same order, as the Cartesian product of the
+        # sub-pattern matches
+        compiled = pattern.compile()
+        c2nodes = compute_match_matrix(compiled, tree)
+        root2matches = [[n for n in c2nodes[p.constraint]
+                         if children_match(n, p, c2nodes)]
+                        for p in compiled.subpatterns]
+        p2index = dict((p, i) for i, p in enumerate(compiled.subpatterns))
+        expected = []
+        for nodes in itertools.product(*root2matches):
+            if len(set(nodes)) != len(nodes):
+                continue
+            ancestors = []
+            for group in compiled.expected_groups:
+                anc = tree.get_common_ancestor([nodes[p2index[p]] for p in group])
+                if anc in ancestors:
+                    break
+                ancestors.append(anc)
+            else:
+                expected.append(ancestors[-1])
+        self.assertEqual(matches, expected)
+        self.assertTrue(len(matches) > 0)
+
+
+class Test_vectorized_constraints(unittest.TestCase):
+    def test_vectorized_constraints(self):
+        tree = Tree("(((a:1, b:2)x:1, (c:0.5, d)y)z, ((e, f:3)w, g)v)r;", format=1)
+        cache = TreePatternCache(tree)
+        nodes = cache.get_node_list()
+        self.assertEqual(set(nodes), set(tree.traverse()))
+        constraints = ["@.dist > 1", "0.5 <= @.dist < 2 and not @.is_leaf()",
+                       "@.name in ('a', 'x') or len(@.children) == 2",
+                       "@.name != 'z' and not @.children", "True"]
+        for constraint in constraints:
+            vectorized = vectorize_constraint(constraint.replace("@", "__target_node"))
+            if vectorized is None:
+                # NumPy is not available
+                return
+            expected = [bool(eval(constraint.replace("@", "node"))) for node in nodes]
+            self.assertEqual(list(vectorized(cache)), expected)
+
+            if "@" not in constraint:
+                continue
+            # and used by searches (a single pattern node matches leaves)
+            pattern = TreePattern("'%s';" % constraint.replace("'", '"'),
+                                  quoted_node_names=True)
+            self.assertEqual(set(pattern.find_match(tree)),
+                             set(n for n, match in zip(nodes, expected)
+                                 if match and not n.children))
+
+    def test_fallback(self):
+        for constraint in ["@.dist > @.up.dist", "len(@) > 2", "@.name.startswith('a')"]:
+            self.assertEqual(vectorize_constraint(constraint.replace("@", "__target_node")), None)
+
+        # custom attributes are vectorized as object columns, and unsupported
+        # constraints are evaluated node by node
+        tree = Tree("((a, b)x, (c, d)y);", format=1)
+        for node in tree.traverse():
+            node.add_feature("code", node.name.upper())
+        for newick in ["('@.code == \"A\"', b)'@.code in (\"X\", \"Y\")';",
+                       "('@.name.startswith(\"a\")', b)x;"]:
+            pattern = TreePattern(newick, quoted_node_names=True)
+            self.assertEqual(list(pattern.find_match(tree)), [tree.children[0]])
+
+    def test_cache_is_bounded(self):
+        maxsize = tm._VECTOR_CACHE.maxsize
+        for i in range(maxsize + 1):
+            vectorize_constraint("__target_node.dist > %d" % i)
+        self.assertEqual(len(tm._VECTOR_CACHE), maxsize)
+
+
+class Test_search_stats(unittest.TestCase):
+    def test_search_stats(self):
+        tree = PhyloTree("(((Hsa_1, Mmu_1), (Hsa_2, Ptr_1)), ((Hsa_3, Mmu_2), Dme_1));")
+        pattern = TreePattern("((Hsa_1, '@.species == \"Mmu\"')^, 'contains_species(@, [\"Dme\"])');",
+                              quoted_node_names=True)
+        stats = SearchStats()
+        matches = list(pattern.find_match(tree, stats=stats))
+        self.assertEqual(stats.trees, 1)
+        self.assertEqual(stats.matches, len(matches))
+        self.assertTrue(stats.evaluations > 0)
+        self.assertTrue(stats.combinations > 0)
+        self.assertTrue(stats.products >= stats.lca_calls > 0)
+        self.assertTrue(stats.candidates[pattern.compile().root.constraint] > 0)
+
+        # trees lacking a required name are rejected before the search
+        TreePattern("(Hsa_1, Xxx_1);").exists(tree, stats=stats)
+        self.assertEqual((stats.trees, stats.rejected), (2, 1))
+
+        # pattern sets record the searches of every pattern separately
+        pattern_set = PatternSet([pattern, TreePattern("(Hsa_1, Mmu_1);")])
+        all_stats = [SearchStats(), SearchStats()]
+        self.assertEqual(pattern_set.count(tree, stats=all_stats), [1, 1])
+        self.assertEqual([s.matches for s in all_stats], [1, 1])
+        total = SearchStats()
+        for pattern_stats in all_stats:
+            total.update(pattern_stats)
+        self.assertEqual((total.trees, total.matches), (2, 2))
+
+
+class Test_search_budget(unittest.TestCase):
+    def test_search_budget(self):
+        # every combination of three "a" leaves has to be checked
+        tree = Tree("(%s);" % ",".join(["(a, b)"] * 100))
+        pattern = TreePattern("(a, a, a)^;")
+        for budget in [SearchBudget(max_combinations=1000), SearchBudget(max_time=0.1),
+                       SearchBudget(max_candidates=50)]:
+            stats = SearchStats()
+            self.assertRaises(SearchBudgetExceeded, pattern.count, tree,
+                              stats=stats, budget=budget)
+            self.assertEqual(stats.trees, 1)
+        self.assertTrue(pattern.exists(tree, budget=SearchBudget(max_time=10)))
+
+        # the other patterns of a set are still searched
+        pattern_set = PatternSet([pattern, TreePattern("(a, b);")])
+        try:
+            pattern_set.count(tree, budget=SearchBudget(max_combinations=1000))
+        except SearchBudgetExceeded as e:
+            self.assertEqual((e.patterns, e.results), ([0], [None, 100]))
+        else:
+            self.fail("SearchBudgetExceeded not raised")
+
+    def test_slow_constraints(self):
+        # the budget limits the evaluation of constraints too
+        class SlowSyntax(PatternSyntax):
+            def slow(self, node):
+                time.sleep(0.001)
+                return True
+
+        tree = Tree()
+        tree.populate(1000)
+        pattern = TreePattern("('slow(@)', 'slow(@)');", syntax=SlowSyntax(),
+                              quoted_node_names=True)
+        pattern_set = PatternSet([pattern, TreePattern("(a, b);")])
+        start = time.time()
+        try:
+            pattern_set.count(tree, budget=SearchBudget(max_time=0.05))
+        except SearchBudgetExceeded as e:
+            self.assertEqual(e.patterns, [0])
+        else:
+            self.fail("SearchBudgetExceeded not raised")
+        self.assertLess(time.time() - start, 0.5)
+
+        # candidates are counted before evaluating any constraint
+        stats = [SearchStats(), SearchStats()]
+        self.assertRaises(SearchBudgetExceeded, pattern_set.count, tree, stats=stats,
+                          budget=SearchBudget(max_candidates=100))
+        self.assertEqual(stats[0].evaluations, 0)
+
+class Test_tree_state(unittest.TestCase):
+    def test_tree_state(self):
+        tree = PhyloTree("((Hsa_1:1,Mmu_1:0.5)0.9,(Hsa_2,(Ptr_1,Dme_1)):2);")
+        tree.search_nodes(name="Ptr_1")[0].add_feature("evoltype", "S")
+        state = pickle.loads(pickle.dumps(TreePatternCache(tree).get_state()))
+        cache = load_tree_cache(state)
+        self.assertEqual(cache.tree.write(features=[]), tree.write(features=[]))
+        self.assertEqual(cache.get_preorder()[0], list(cache.tree.traverse("preorder")))
+        self.assertEqual(cache.get_species(cache.tree), set(["Hsa", "Mmu", "Ptr", "Dme"]))
+        for newick in ["(Hsa_1, Mmu_1);", "(Dme_1, 'getattr(@, \"evoltype\", \"\") == \"S\"');",
+                       "(Hsa_2, (Ptr_1, Dme_1))'n_species(@) == 3 and contains_species(@, [\"Ptr\"])';"]:
+            pattern = TreePattern(newick)
+            self.assertEqual(pattern.count(cache.tree, cache), 1)
+
+        state['version'] = None
+        self.assertRaises(ValueError, load_tree_cache, state)
+
+        # species of Tree nodes are regular features
+        tree = Tree("((a,b),c);")
+        for leaf, species in zip(tree, ["x", "y", "x"]):
+            leaf.add_feature("species", species)
+        cache = load_tree_cache(TreePatternCache(tree).get_state())
+        self.assertEqual(cache.tree.write(features=["species"]), tree.write(features=["species"]))
+        self.assertEqual(cache.get_n_species(cache.tree), 2)
+        self.assertEqual(cache.get_n_leaves(cache.tree.children[0]), 2)
+
+class Test_match_session(unittest.TestCase):
+    def test_match_session(self):
+        tree = PhyloTree("(((Hsa_1,Mmu_1),(Hsa_1,Ptr_1)),((Mmu_1,Dme_1),Hsa_2));")
+        patterns = [TreePattern("(Hsa_1, Mmu_1);"), TreePattern("(Hsa_1, Dme_1)^;"),
+                    TreePattern("((Mmu_1, Dme_1)'n_species(@) == 2', Hsa_2);",
+                                quoted_node_names=True)]
+        session = MatchSession(tree, patterns)
+
+        def check():
+            for pattern, matches in zip(patterns, session.matches):
+                self.assertEqual(matches, set(pattern.find_match(tree)))
+
+        check()
+        self.assertEqual([len(m) for m in session.matches], [1, 1, 1])
+
+        # annotation
+        leaf = tree.search_nodes(name="Ptr_1")[0]
+        leaf.name = "Mmu_1"
+        added, removed = session.update([leaf])[0]
+        self.assertEqual((added, removed), (set([leaf.up]), set()))
+        check()
+
+        # pruning
+        node = tree.search_nodes(name="Dme_1")[0]
+        parent = node.up
+        node.detach()
+        session.update([parent])
+        check()
+        self.assertEqual([len(m) for m in session.matches], [2, 0, 0])
+
+        # grafting and re-rooting
+        tree.children[0].add_child(PhyloTree("(Dme_1,Hsa_2);"))
+        session.update([tree.children[0]])
+        check()
+        before = dict((n, list(n.children)) for n in tree.traverse())
+        tree.set_outgroup(tree.search_nodes(name="Hsa_2")[0])
+        session.update([n for n in tree.traverse() if before.get(n) != n.children])
+        check()
+
+
 if __name__ == '__main__':
     unittest.main()
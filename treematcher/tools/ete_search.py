@@ -1,15 +1,27 @@
 #!/usr/bin/env python
 
+import os
+import re
 import sys
+import gzip
+import mmap
+import struct
+import shutil
+import hashlib
 import logging
+import tempfile
 import os.path
+import threading
 
-from argparse import ArgumentParser
-from ete3.tools.common import src_tree_iterator
+from argparse import ArgumentParser, Namespace
+from multiprocessing import Pool
+from six.moves import cPickle as pickle
 from ete3.phylo import PhyloTree
-from ete3 import NodeStyle, TreeStyle
 
-from treematcher.treematcher import TreePattern
+from treematcher.treematcher import (TreePattern, PatternSet, SearchStats,
+                                     SearchBudget, SearchBudgetExceeded,
+                                     TreePatternCache, load_tree_cache,
+                                     TREE_STATE_VERSION)
 
 
 class match_stats(object):
@@ -21,6 +33,8 @@ class match_stats(object):
         self.matched = 0
         self.not_matched = 0
         self.errors = 0
+        self.budget_exceeded = 0 # also counted as errors
+        self.search = None       # SearchStats, only with --profile
 
     def __str__(self):
         printable = "{}\n".format(self.name)
@@ -33,6 +47,10 @@ class match_stats(object):
             printable += "Number of trees: {}\n".format(self.num_of_trees)
 
         printable +="Errors: {}\n".format(self.errors)
+        if self.budget_exceeded > 0:
+            printable += "Search budget exceeded: {}\n".format(self.budget_exceeded)
+        if self.search is not None:
+            printable += "{}".format(self.search)
         return printable
 
 DESC='Search for strict or relax described (using regexp logic) patterns in newick trees.\n'
@@ -62,7 +80,17 @@ def populate_args(treematcher_args_p):
                                 "quoted strings) to be used as target tree(s)"))
     treematcher_args.add_argument("--target_tree_list", dest="src_tree_list",
                               type=str,
-                              help=("path to a file containing many pattern trees, one per line"))
+                              help=("path to a file (plain or gzipped) containing many target\
+                              trees, each one ending with ';'"))
+    treematcher_args.add_argument("--mmap", dest="use_mmap", action="store_true",
+                              help=("memory-map the --target_tree_list file instead of reading it."))
+    treematcher_args.add_argument("--tree_cache", dest="tree_cache", type=str,
+                              help=("directory where the trees of --target_tree_list are\
+                              stored parsed and indexed the first time they are searched,\
+                              so later runs load them instead of parsing them again. The\
+                              cache of a file is rebuilt when the file or --tree_format\
+                              change. Cache files are pickles: only use a directory\
+                              you trust."))
     treematcher_args.add_argument("-p", dest='pattern_trees',
                               type=str, nargs="*",
                               help=("a list of trees in newick format (filenames or"
@@ -78,168 +106,649 @@ def populate_args(treematcher_args_p):
     treematcher_args.add_argument("-r", "--root", dest="whole_tree", action="store_true",
                                     help=("Returns the tree from root if match found. Is used as\
                                     flag to indicate match presence rather than match it self."))
+    treematcher_args.add_argument("-c", "--count", dest="count", action="store_true",
+                                    help=("Report the number of matches in each tree instead\
+                                    of the matches themselves."))
     treematcher_args.add_argument("-v", "--verbosity", dest="verbosity",
                                     type=int, nargs=1,
                                     help=("A number between 1-4. The verbosity level.\
                                     1: print matches (default), 2: print statistsics, \
                                     3: print the pattern, 4: print statistsics for \
                                     each pattern."))
+    treematcher_args.add_argument("--profile", dest="profile", action="store_true",
+                                    help=("Record the constraint evaluations, candidates,\
+                                    children combinations, loose join products and the\
+                                    time of every search phase, and print them with the\
+                                    statistics of every pattern (to standard error)."))
+    treematcher_args.add_argument("--max_time", dest="max_time",
+                                    type=float,
+                                    help=("Maximum time in seconds to search a pattern in\
+                                    a tree. Searches exceeding it are aborted and counted\
+                                    as errors."))
+    treematcher_args.add_argument("--max_combinations", dest="max_combinations",
+                                    type=int,
+                                    help=("Maximum number of children combinations and\
+                                    loose connection products tried to search a pattern\
+                                    in a tree."))
+    treematcher_args.add_argument("--max_candidates", dest="max_candidates",
+                                    type=int,
+                                    help=("Maximum number of candidate nodes of the\
+                                    constraints of a pattern in a tree."))
+    treematcher_args.add_argument("--cpu", dest="cpu",
+                                    type=int, default=1,
+                                    help=("Number of processes used to search the\
+                                    target trees in parallel (default 1)."))
+    treematcher_args.add_argument("--unordered", dest="unordered", action="store_true",
+                                    help=("With --cpu, report the results of each target\
+                                    tree as soon as they are ready instead of in input order."))
+    treematcher_args.add_argument("--chunk_size", dest="chunk_size",
+                                    type=int, default=64,
+                                    help=("With --cpu, number of target trees sent to a\
+                                    worker process at once (default 64)."))
+
+def render_matches(args, pattern_num, pattern_length, n, t, matches):
+    """ Renders the matches of a pattern in a target tree to image files. """
+    match_length = len(matches)
+    image = args.render
+    if vars(args)["whole_tree"]:
+        if pattern_length > 1:  # multiple patterns
+            if '.' in image:
+                image = image.replace('.', str(pattern_num) + '.')
+            else:
+                image += str(pattern_num)
+        # the tree styles need PyQt, so they are only imported when rendering
+        from ete3 import NodeStyle, TreeStyle
+        ts = TreeStyle()
+        ts.show_leaf_name = True
+        for node in t.traverse():
+            nstyle = NodeStyle()
+            if node in matches:
+                nstyle["fgcolor"] = "green"
+                nstyle["size"] = 7
+            else:
+                nstyle["fgcolor"] = "red"
+                nstyle["size"] = 5
+            node.set_style(nstyle)
+
+        t.render(image, tree_style=ts, layout=lambda x: None)
+    else:
+        if pattern_length > 1:  # multiple patterns
+            if match_length > 1:  # one file per match on each pattern
+                for m, match in enumerate(matches):
+                    if '.' in image:
+                        image = image.replace('.', str(pattern_num) + '_' + str(m) + '.')
+                    else:
+                        image += str(pattern_num) + str(m)
+                    match.render(image)
+            elif match_length == 1:  # One match on multiple patterns
+                if '.' in image:
+                    image = image.replace('.', str(pattern_num) + '.')
+                else:
+                    image += str(pattern_num)
+                matches[0].render(image)
+            else:
+                if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
+                    print("No matches for pattern {} tree {}".format(pattern_num, n))
+        else:  # one pattern
+            if match_length > 1:  # one file per match on one pattern
+                for m, match in enumerate(matches):
+                    if '.' in image:
+                        image = image.replace('.', '_' + str(m) + '.')
+                    else:
+                        image += str(m)
+                    match.render(image)
+            elif match_length == 1:  # one file for one match
+                matches[0].render(image)
+            else:
+                if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
+                    print("No matches for tree {}".format(n))
+
+def format_matches(args, t, matches):
+    """ Returns the text reporting the matches of a pattern in a target tree,
+    as it is written to the output file or to the standard output. """
+    match_length = len(matches)
+    if vars(args)["output"]:
+        if vars(args)["asciioutput"]:
+            if vars(args)["whole_tree"] and match_length > 0:
+                return str(t)
+            else:
+                return ''.join([str(match) + '\n' for match in matches])
+        else:  #args.taboutput
+            if vars(args)["whole_tree"]:
+                return t.write(features=[])
+            else:
+                return '\t'.join([match.write(features=[]) for match in matches])
+
+    if args.render:
+        return ''
+
+    if vars(args)["asciioutput"]:
+        if vars(args)["whole_tree"] and match_length > 0:
+            lines = [str(t)]
+        else:
+            lines = [str(match) for match in matches]
+    else:
+        if vars(args)["whole_tree"] and match_length > 0:
+            lines = [t.write(features=[])]
+        else:
+            lines = [match.write(features=[]) for match in matches]
+    return ''.join([line + '\n' for line in lines])
+
+def search_budget(args):
+    """ Returns the SearchBudget set by the command line, or None. """
+    limits = [vars(args)[name] for name in ["max_time", "max_combinations",
+                                            "max_candidates"]]
+    if all(limit is None for limit in limits):
+        return None
+    return SearchBudget(*limits)
+
+def search_tree(args, pattern_set, nw, search_stats=None):
+    """ Parses a target tree and searches it for all the patterns of
+    pattern_set. Returns None if the tree could not be parsed, otherwise the
+    tree and the list of matches found for every pattern (or the number of
+    matches with --count), which is None for the patterns whose search
+    exceeded the budget. With --profile, the searches are recorded in
+    search_stats (a SearchStats instance per pattern). """
+    cache = None
+    try:
+        if isinstance(nw, CachedTree):
+            cache = nw.load()
+            t = cache.tree
+        else:
+            t = PhyloTree(nw, format=args.tree_format)
+    except:
+        logging.error("Could not creat tree from newick format.")
+        return None
+
+    budget = search_budget(args)
+    if vars(args)["count"]:
+        try:
+            return t, pattern_set.count(t, cache, stats=search_stats, budget=budget)
+        except SearchBudgetExceeded as e:
+            return t, e.results
+
+    if vars(args)["whole_tree"] and not args.render:
+        # only the presence of a match is reported, so the search of each
+        # pattern stops at its first match
+        try:
+            found = pattern_set.exists(t, cache, stats=search_stats, budget=budget)
+        except SearchBudgetExceeded as e:
+            found = e.results
+        return t, [None if f is None else [t] if f else [] for f in found]
+
+    all_matches = [[] for _ in range(len(pattern_set))]
+    try:
+        for i, match in pattern_set.find_matches(t, cache, stats=search_stats,
+                                                 budget=budget):
+            all_matches[i].append(match)
+    except SearchBudgetExceeded as e:
+        for i in e.patterns:
+            all_matches[i] = None
+    return t, all_matches
+
+def report_results(args, t, results):
+    """ Returns the number of matches and the formatted output of the results
+    of every pattern in a target tree (None and no output for the searches
+    exceeding the budget). """
+    if vars(args)["count"]:
+        return [(None, "") if count is None else (count, "{}\n".format(count))
+                for count in results]
+    return [(None, "") if matches is None else
+            (len(matches), format_matches(args, t, matches)) for matches in results]
+
+def open_output_file(args, pattern_num, pattern_length):
+    filename = vars(args)["output"]
+    if pattern_length > 1:
+        if '.' in vars(args)["output"]:
+            filename = filename.replace('.', str(pattern_num) + '.')
+        else:
+            filename += str(pattern_num)
+
+    return open(filename, 'w')
 
 def run(args):
-    # a list of stats objects. one for every pattern
-    all_stats = []
-
     if vars(args)["src_trees"] is None and vars(args)["src_tree_list"] is None:
         logging.error('Please specify a tree to search (i.e. -t) ')
         sys.exit(-1)
     if not vars(args)["pattern_trees"] and not vars(args)["pattern_tree_list"]:
         logging.error('Please specify a pattern to search for. (i.e. -p)')
         sys.exit(-1)
+    if vars(args)["count"] and args.render:
+        logging.error('Matches can not be rendered when only counting them (i.e. -c)')
+        sys.exit(-1)
+
 
+    # patterns are read only once (they could come from standard input)
+    pattern_trees = list(pattern_tree_iterator(args))
 
-    pattern_length = len(list(pattern_tree_iterator(args)))
+    # a list of stats objects. one for every pattern
+    all_stats = run_search(args, pattern_trees)
+
+    concentrated = match_stats("\nSummarize")
+    concentrated.total = sum([ stat.total for stat in all_stats])
+    concentrated.num_of_patterns = len(all_stats)
+    concentrated.num_of_trees = concentrated.total / concentrated.num_of_patterns
+    concentrated.matched = sum([stat.matched for stat in all_stats])
+    concentrated.not_matched = sum([stat.not_matched for stat in all_stats])
+    concentrated.errors = sum([stat.errors for stat in all_stats])
+    concentrated.budget_exceeded = sum([stat.budget_exceeded for stat in all_stats])
+    if vars(args)["profile"]:
+        concentrated.search = SearchStats()
+        for stat in all_stats:
+            concentrated.search.update(stat.search)
+
+    if vars(args)["profile"]:
+        sys.stderr.write("{}\n".format(concentrated))
+    elif vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
+        print("{}".format(concentrated))
 
-    for pattern_num, p in enumerate(pattern_tree_iterator(args)):
+# per-process state of the worker processes used with --cpu
+_worker_args = None
+_worker_pattern_set = None
+
+# options of the command line needed to search and format the matches
+WORKER_OPTIONS = ["quoted_node_names", "tree_format", "whole_tree", "output",
+                  "asciioutput", "taboutput", "render", "verbosity", "count",
+                  "profile", "max_time", "max_combinations", "max_candidates"]
+
+def init_worker(options, pattern_newicks):
+    """ Initializes a worker process, compiling the patterns once per process. """
+    global _worker_args, _worker_pattern_set
+    _worker_args = Namespace(**options)
+    _worker_pattern_set = PatternSet([
+        TreePattern(p, quoted_node_names=options["quoted_node_names"])
+        for p in pattern_newicks])
+
+def search_tree_item(item):
+    """ Searches one target tree in a worker process. Returns the position of
+    the tree, the number of matches and the formatted output for every pattern
+    (None if the tree could not be parsed) and, with --profile, the
+    SearchStats of every pattern. """
+    n, nw = item
+    search_stats = None
+    if _worker_args.profile:
+        search_stats = [SearchStats() for _ in range(len(_worker_pattern_set))]
+    found = search_tree(_worker_args, _worker_pattern_set, nw, search_stats)
+    if found is None:
+        return n, None, search_stats
+    t, results = found
+    return n, report_results(_worker_args, t, results), search_stats
+
+def serial_search(args, pattern_set, trees, search_stats=None):
+    """ Searches the target trees in the current process, yielding the
+    position of every tree, the number of matches and the formatted output of
+    every pattern, and the tree and the matches found. """
+    for n, nw in trees:
+        found = search_tree(args, pattern_set, nw, search_stats)
+        if found is None:
+            yield n, None, None
+            continue
+        t, results = found
+        yield n, report_results(args, t, results), found
+
+class InFlightLimit(object):
+    def __init__(self, limit):
+        """ Bounds the number of target trees handed to a pool of processes
+        and not yet reported, so the input is read lazily while the workers
+        are kept busy.
+
+        :param limit: maximum number of trees in flight.
+        """
+        self.limit = limit
+        self.in_flight = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def feed(self, items):
+        """ Iterates over items, waiting while the limit is reached. Runs in
+        the thread of the pool that sends the tasks. """
+        for item in items:
+            with self.condition:
+                while self.in_flight >= self.limit and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                self.in_flight += 1
+            yield item
+
+    def release(self):
+        """ Called when the result of an item is reported. """
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def stop(self):
+        """ Stops feeding items (e.g., when the search is aborted). """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+def parallel_search(args, pattern_newicks, trees, search_stats=None):
+    """ Distributes the target trees in chunks among a pool of --cpu worker
+    processes, yielding the results in input order unless --unordered is
+    used. With --profile, the SearchStats of the workers are added to
+    search_stats.
+
+    A single stream of tasks feeds the pool, so a slow tree only holds its
+    own worker. At most cpu * chunk_size * 4 trees are read ahead of the
+    results reported.
+    """
+    options = dict((name, vars(args)[name]) for name in WORKER_OPTIONS)
+    pool = Pool(processes=args.cpu, initializer=init_worker,
+                initargs=(options, pattern_newicks))
+    limit = InFlightLimit(args.cpu * args.chunk_size * 4)
+    try:
+        if args.unordered:
+            results = pool.imap_unordered(search_tree_item, limit.feed(trees), args.chunk_size)
+        else:
+            results = pool.imap(search_tree_item, limit.feed(trees), args.chunk_size)
+        for n, reports, tree_stats in results:
+            limit.release()
+            if search_stats is not None:
+                for stats, other in zip(search_stats, tree_stats):
+                    stats.update(other)
+            yield n, reports, None
+        pool.close()
+    except:
+        limit.stop()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def run_search(args, pattern_trees):
+    """ Searches all patterns at once, so every target tree is parsed and
+    traversed only once to evaluate the constraints of all patterns. Returns
+    the stats of every pattern.
+
+    The matches printed to standard output are still reported pattern by
+    pattern: with several patterns, the output of each one is kept in a
+    temporary file until all trees are searched. """
+    pattern_length = len(pattern_trees)
+    patterns = []
+    pattern_nums = []
+    for pattern_num, p in enumerate(pattern_trees):
         try :
             pattern = TreePattern(p, quoted_node_names=vars(args)["quoted_node_names"])
         except:
             logging.error("Could not create pattern from newick.")
             continue
 
-        stats = match_stats("pattern_" + str(pattern_num))
-
-        # handle file creation
-        if vars(args)["output"]:
-            filename = vars(args)["output"]
-            if pattern_length > 1:
-                if '.' in vars(args)["output"]:
-                    filename = filename.replace('.', str(pattern_num) + '.')
-                else:
-                    filename += str(pattern_num)
-
-            outputfile = open(filename, 'w')
-
         if vars(args)["verbosity"] and int(vars(args)["verbosity"][0]) > 2:
             print("pattern_{} is: ".format(pattern_num))
             print(pattern)
 
-        # for every tree
-        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 2 and not vars(args)["output"]:
-            print("match(es) for pattern_{}:".format(pattern_num))
-
-        for n, nw in enumerate(src_tree_iterator(args)):
+        patterns.append(pattern)
+        pattern_nums.append(pattern_num)
+
+    pattern_set = PatternSet(patterns)
+    all_stats = [match_stats("pattern_" + str(pattern_num))
+                 for pattern_num in pattern_nums]
+    search_stats = None
+    if vars(args)["profile"]:
+        search_stats = [SearchStats() for _ in patterns]
+        for stats, pattern_search_stats in zip(all_stats, search_stats):
+            stats.search = pattern_search_stats
+    outputfiles = [None] * len(patterns)
+    if vars(args)["output"]:
+        outputfiles = [open_output_file(args, pattern_num, pattern_length)
+                       for pattern_num in pattern_nums]
+    elif len(patterns) > 1:
+        outputfiles = [tempfile.TemporaryFile(mode='w+') for _ in patterns]
+
+    print_headers = (vars(args)["verbosity"] and vars(args)["verbosity"][0] > 2
+                     and not vars(args)["output"])
+    if print_headers and len(patterns) == 1:
+        print("match(es) for pattern_{}:".format(pattern_nums[0]))
+
+    trees = enumerate(target_tree_iterator(args))
+    if args.cpu > 1 and args.render:
+        logging.warning("Rendering is done in a single process, --cpu is ignored.")
+    if args.cpu > 1 and not args.render:
+        pattern_newicks = [pattern_trees[pattern_num] for pattern_num in pattern_nums]
+        results = parallel_search(args, pattern_newicks, trees, search_stats)
+    else:
+        results = serial_search(args, pattern_set, trees, search_stats)
+
+    for n, reports, found in results:
+        for stats in all_stats:
             stats.total += 1
-            try:
-                t = PhyloTree(nw, format=args.tree_format)
-            except:
-                logging.error("Could not creat tree from newick format.")
+        if reports is None:
+            for stats in all_stats:
                 stats.errors += 1
-                continue
+            continue
 
-            matches = list(pattern.find_match(t))
-            match_length=len(matches)
+        for i, (match_length, text) in enumerate(reports):
+            if match_length is None:
+                logging.error("Search budget exceeded by pattern_{} in tree {}".format(
+                    pattern_nums[i], n))
+                all_stats[i].errors += 1
+                all_stats[i].budget_exceeded += 1
+                continue
             if match_length > 0:
-                stats.matched += 1
+                all_stats[i].matched += 1
             else:
-                stats.not_matched += 1
-
-            if args.render:
-                image = args.render
-                if vars(args)["whole_tree"]:
-                    if pattern_length > 1:  # multiple patterns
-                        if '.' in image:
-                            image = image.replace('.', str(pattern_num) + '.')
-                        else:
-                            image += str(pattern_num)
-                    ts = TreeStyle()
-                    ts.show_leaf_name = True
-                    for n in t.traverse():
-                        nstyle = NodeStyle()
-                        if n in matches:
-                            nstyle["fgcolor"] = "green"
-                            nstyle["size"] = 7
-                        else:
-                            nstyle["fgcolor"] = "red"
-                            nstyle["size"] = 5
-                        n.set_style(nstyle)
-
-                    t.render(image, tree_style=ts, layout=lambda x: None)
-                else:
-                    if pattern_length > 1:  # multiple patterns
-                        if match_length > 1:  # one file per match on each pattern
-                            for m, match in enumerate(matches):
-                                if '.' in image:
-                                    image = image.replace('.', str(pattern_num) + '_' + str(m) + '.')
-                                else:
-                                    image += str(pattern_num) + str(m)
-                                match.render(image)
-                        elif match_length == 1:  # One match on multiple patterns
-                            if '.' in image:
-                                image = image.replace('.', str(pattern_num) + '.')
-                            else:
-                                image += str(pattern_num)
-                            matches[0].render(image)
-                        else:
-                            if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
-                                print("No matches for pattern {} tree {}".format(pattern_num, n))
-                    else:  # one pattern
-                        if match_length > 1:  # one file per match on one pattern
-                            for m, match in enumerate(matches):
-                                if '.' in image:
-                                    image = image.replace('.', '_' + str(m) + '.')
-                                else:
-                                    image += str(m)
-                                match.render(image)
-                        elif match_length == 1:  # one file for one match
-                            matches[0].render(image)
-                        else:
-                            if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
-                                print("No matches for tree {}".format(n))
-
-            if vars(args)["output"]:
-                if vars(args)["asciioutput"]:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        outputfile.write(str(t))
-                    else:
-                        for match in matches:
-                            outputfile.write(str(match) + '\n')
-                else:  #args.taboutput
-                    if vars(args)["whole_tree"]:
-                        outputfile.whrite(t.write(features=[]))
-                    else:
-                        outputfile.write('\t'.join([match.write(features=[]) for match in matches]))
-
-            if not vars(args)["output"] and not args.render:
-                if vars(args)["asciioutput"]:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        print(t)
-                    else:
-                        for match in matches:
-                            print(match)
-                else:
-                    if vars(args)["whole_tree"] and match_length > 0:
-                        print(t.write(features=[]))
-                    else:
-                        for match in matches:
-                            print(match.write(features=[]))
-
-        all_stats += [stats]
-        if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 3:
+                all_stats[i].not_matched += 1
+
+            if found is not None and args.render:
+                t, all_matches = found
+                render_matches(args, pattern_nums[i], pattern_length, n, t,
+                               all_matches[i])
+            if outputfiles[i]:
+                outputfiles[i].write(text)
+            elif text:
+                sys.stdout.write(text)
+
+    for pattern_num, stats, outputfile in zip(pattern_nums, all_stats, outputfiles):
+        if outputfile and not vars(args)["output"]:
+            if print_headers:
+                print("match(es) for pattern_{}:".format(pattern_num))
+            outputfile.seek(0)
+            shutil.copyfileobj(outputfile, sys.stdout)
+        if vars(args)["profile"]:
+            sys.stderr.write("{}\n".format(stats))
+        elif vars(args)["verbosity"] and vars(args)["verbosity"][0] > 3:
             print("{}".format(stats))
-
-        if vars(args)["output"]:
+        if outputfile:
             outputfile.close()
 
-    concentrated = match_stats("\nSummarize")
-    concentrated.total = sum([ stat.total for stat in all_stats])
-    concentrated.num_of_patterns = len(all_stats)
-    concentrated.num_of_trees = concentrated.total / concentrated.num_of_patterns
-    concentrated.matched = sum([stat.matched for stat in all_stats])
-    concentrated.not_matched = sum([stat.not_matched for stat in all_stats])
-    concentrated.errors = sum([stat.errors for stat in all_stats])
-
-    if vars(args)["verbosity"] and vars(args)["verbosity"][0] > 1:
-        print("{}".format(concentrated))
+    return all_stats
+
+# characters that end a newick record or delimit a [comment]
+NEWICK_DELIMITERS = re.compile(b"[;\\[\\]]")
+GZIP_MAGIC = b"\x1f\x8b"
+
+def newick_record_iterator(path, use_mmap=False, chunk_size=1 << 20):
+    """ Reads a plain or gzipped file of newick trees in chunks and yields its
+    records one by one, so only the record being read is kept in memory.
+
+    :param path: the file to read. Gzipped files are detected from their
+      first bytes.
+    :param False use_mmap: memory-map the file instead of reading it (plain
+      files only).
+    :param chunk_size: number of bytes read at once.
+
+    Records end with ';' and may span several lines. A ';' inside a
+    [comment] does not end the record.
+    """
+    with open(path, 'rb') as handle:
+        compressed = handle.read(2) == GZIP_MAGIC
+
+    mapped = None
+    if compressed:
+        stream = gzip.open(path, 'rb')
+        chunks = iter(lambda: stream.read(chunk_size), b'')
+    elif use_mmap and os.path.getsize(path) > 0:
+        stream = open(path, 'rb')
+        mapped = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        chunks = (mapped[i:i + chunk_size] for i in range(0, len(mapped), chunk_size))
+    else:
+        stream = open(path, 'rb')
+        chunks = iter(lambda: stream.read(chunk_size), b'')
+
+    try:
+        parts = []
+        in_comment = False
+        for chunk in chunks:
+            start = pos = 0
+            while True:
+                delimiter = NEWICK_DELIMITERS.search(chunk, pos)
+                if not delimiter:
+                    parts.append(chunk[start:])
+                    break
+                pos = delimiter.end()
+                char = chunk[delimiter.start():pos]
+                if in_comment:
+                    in_comment = char != b']'
+                elif char == b'[':
+                    in_comment = True
+                elif char == b';':
+                    parts.append(chunk[start:pos])
+                    start = pos
+                    record = b''.join(parts).strip()
+                    parts = []
+                    if record != b';':
+                        yield record.decode('utf-8')
+
+        # an unterminated last record is reported as a malformed tree
+        record = b''.join(parts).strip()
+        if record:
+            yield record.decode('utf-8')
+    finally:
+        if mapped is not None:
+            mapped.close()
+        stream.close()
+
+# first bytes of the tree cache files
+TREE_CACHE_MAGIC = b"TMTREES\x01"
+# size of every record in the tree cache files
+TREE_CACHE_RECORD = struct.Struct("<Q")
+
+class CachedTree(object):
+    def __init__(self, data):
+        """ A target tree read from a tree cache file, which is only decoded
+        when it is searched (in the worker processes with --cpu).
+
+        :param data: the pickled state of the tree (see
+          TreePatternCache.get_state), or of None if the tree could not be
+          parsed.
+        """
+        self.data = data
+
+    def load(self):
+        """ Returns the TreePatternCache of the tree, with the tree in its
+        tree attribute. """
+        state = pickle.loads(self.data)
+        if state is None:
+            raise ValueError("Tree could not be parsed")
+        return load_tree_cache(state)
+
+def file_digest(path, chunk_size=1 << 20):
+    """ Returns the SHA-1 hex digest of the content of a file. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def tree_cache_path(args):
+    """ Returns the path of the tree cache file of --target_tree_list. Files
+    are told apart by their absolute path, so tree lists with the same name in
+    different directories can share a cache directory.
+
+    Tree cache files are pickles, which can run arbitrary code when loaded, so
+    --tree_cache must be a directory only trusted users can write to. """
+    src_tree_list = os.path.abspath(vars(args)["src_tree_list"])
+    path_digest = hashlib.sha1(src_tree_list.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(vars(args)["tree_cache"],
+                        "{}.{}.tmcache".format(os.path.basename(src_tree_list),
+                                               path_digest))
+
+def tree_cache_header(args):
+    """ Returns the header identifying the content of a tree cache file: the
+    source file, how it was parsed and the format of the stored trees. """
+    return {"source": file_digest(vars(args)["src_tree_list"]),
+            "tree_format": vars(args)["tree_format"],
+            "state_version": TREE_STATE_VERSION,
+            "python": sys.version_info[0]}
+
+def write_cache_record(handle, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    handle.write(TREE_CACHE_RECORD.pack(len(data)))
+    handle.write(data)
+
+def read_tree_cache_header(path):
+    """ Returns the header of a tree cache file, or None if it does not
+    exist or is not a tree cache file. """
+    try:
+        with open(path, 'rb') as handle:
+            if handle.read(len(TREE_CACHE_MAGIC)) != TREE_CACHE_MAGIC:
+                return None
+            size, = TREE_CACHE_RECORD.unpack(handle.read(TREE_CACHE_RECORD.size))
+            return pickle.loads(handle.read(size))
+    except Exception:
+        return None
+
+def build_tree_cache(args, path, header):
+    """ Parses and indexes all the trees of --target_tree_list and stores
+    them in a tree cache file. The file is replaced only once it is
+    complete. """
+    if not os.path.isdir(vars(args)["tree_cache"]):
+        os.makedirs(vars(args)["tree_cache"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as handle:
+        handle.write(TREE_CACHE_MAGIC)
+        write_cache_record(handle, header)
+        for nw in newick_record_iterator(vars(args)["src_tree_list"],
+                                         use_mmap=vars(args)["use_mmap"]):
+            try:
+                state = TreePatternCache(PhyloTree(nw, format=args.tree_format)).get_state()
+            except:
+                # reported as a parsing error when it is searched
+                state = None
+            write_cache_record(handle, state)
+    getattr(os, "replace", os.rename)(tmp_path, path)
+
+def cached_tree_iterator(args):
+    """ Yields the trees of --target_tree_list as CachedTree instances, read
+    from its file in --tree_cache, which is built first if it does not exist
+    or is out of date. The cache file is memory-mapped. """
+    path = tree_cache_path(args)
+    header = tree_cache_header(args)
+    if read_tree_cache_header(path) != header:
+        logging.info("Building tree cache {}".format(path))
+        build_tree_cache(args, path, header)
+
+    with open(path, 'rb') as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = len(TREE_CACHE_MAGIC)
+            skip_header = True
+            while pos < len(mapped):
+                size, = TREE_CACHE_RECORD.unpack(mapped[pos:pos + TREE_CACHE_RECORD.size])
+                pos += TREE_CACHE_RECORD.size
+                if not skip_header:
+                    yield CachedTree(mapped[pos:pos + size])
+                skip_header = False
+                pos += size
+        finally:
+            mapped.close()
+
+def target_tree_iterator(args):
+    """ Yields the target trees given with -t, or read lazily from the
+    --target_tree_list file (or its --tree_cache). """
+    if not vars(args)["src_trees"] and not sys.stdin.isatty():
+        vars(args)["src_trees"] = sys.stdin
+    if vars(args)["src_trees"]:
+        for src_tree in vars(args)["src_trees"]:
+            yield src_tree.strip()
+    elif vars(args)["src_tree_list"] and vars(args)["tree_cache"]:
+        for tree in cached_tree_iterator(args):
+            yield tree
+    elif vars(args)["src_tree_list"]:
+        for record in newick_record_iterator(vars(args)["src_tree_list"],
+                                             use_mmap=vars(args)["use_mmap"]):
+            yield record
 
 def pattern_tree_iterator(args):
     if not vars(args)["pattern_trees"] and not sys.stdin.isatty():
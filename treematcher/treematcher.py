@@ -1,23 +1,719 @@
 import re
-import itertools
+import gc
+import ast
+import math
+import operator
+import bisect
+import numbers
+from array import array
 from collections import defaultdict, OrderedDict
+from functools import partial
+from timeit import default_timer as timer
 
 import six
-from copy import deepcopy
+from copy import copy
 from ete3 import PhyloTree, Tree, NCBITaxa
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from pprint import pprint
 
-class TreePatternCache(object):
+class _LRUCache(object):
+    def __init__(self, maxsize):
+        """ Dictionary keeping only the `maxsize` most recently used keys, so
+        caches shared by all patterns cannot grow forever in long running
+        processes.
+
+        :param maxsize: number of entries kept
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        if key in self._data:
+            return self[key]
+        return default
+
+    def clear(self):
+        self._data.clear()
+
+# Code objects of the constraint expressions compiled most recently, so the
+# same expression is not parsed twice (not even across patterns)
+_CONSTRAINT_CODE_CACHE = _LRUCache(512)
+
+def compile_constraint(constraint):
+    """Returns the code object of a constraint expression, compiling it only
+    the first time it is seen.
+
+    :param constraint: python expression as returned by
+        TreePattern.parse_node_name()
+    """
+    code = _CONSTRAINT_CODE_CACHE.get(constraint)
+    if code is None:
+        code = compile(constraint, '<pattern constraint>', 'eval')
+        _CONSTRAINT_CODE_CACHE[constraint] = code
+    return code
+
+def build_constraint_scope(syntax):
+    """Creates the namespace in which pattern constraints are evaluated: a
+    dictionary with all the functions, variables and other stuff provided by a
+    syntax controller. The evaluated node is available as `__target_node`.
+
+    :param syntax: a PatternSyntax (or custom syntax) instance
+    """
+    return {attr_name: getattr(syntax, attr_name)
+            for attr_name in dir(syntax)}
+
+def parse_metacharacters(raw_constraint, has_children):
+    """Takes a string as node name, extracts metacharacters and interpret them as
+    min and max occurrences. Assumes that all metacharacters are defined at
+    the end of the string.
+
+    :param raw_constraint: the name of a pattern node
+    :param has_children: True if the pattern node has children
+
+    :return: a tuple with the clean constraint, min and max number of
+        occurrences and a boolean indicating if children are loosely connected
+    """
+    raw_constraint = raw_constraint.strip()
+    if raw_constraint.endswith('+'):
+        min_occur = 1
+        max_occur = 9999999
+        raw_constraint = raw_constraint[:-1]
+    elif raw_constraint.endswith('*'):
+        min_occur = 0
+        max_occur = 9999999
+        raw_constraint = raw_constraint[:-1]
+    elif raw_constraint.endswith('}'):
+        exp = '\{\s*(\d+)\s*,\s*(\d+)\s*\}'
+        s = re.search(exp, raw_constraint)
+        if s:
+            min_occur, max_occur = map(int, s.groups())
+            raw_constraint = re.sub(exp, '', raw_constraint)
+        else:
+            min_occur = 1
+            max_occur = 1
+
+    else:
+        min_occur = 1
+        max_occur = 1
+
+    if raw_constraint.startswith('^') and has_children:
+        loose_children = True
+        raw_constraint = raw_constraint[1:]
+    else:
+        loose_children = False
+
+    return raw_constraint.strip(), min_occur, max_occur, loose_children
+
+def build_constraint(clean_name, has_children):
+    """Transforms a clean node name (with no metacharacters) into an evaluable
+    python expression.
+
+    :return: a tuple with the python expression and the node name to match if
+        the constraint is a plain node name (otherwise None).
+    """
+    # Translate alias and shortcut expressions in clean names
+    name_constraint = None
+    if '@' not in clean_name:
+        # plain node names can be checked without evaluating any code
+        name_constraint = clean_name
+        constraint = '__target_node.name == "%s"' %clean_name
+    elif clean_name:
+        constraint = clean_name.replace('@', '__target_node')
+    else:
+        constraint = 'True'
+
+    if has_children:
+        constraint = '(%s) and __target_node.children' %constraint
+    else:
+        constraint = '(%s) and not __target_node.children' %constraint
+
+    return constraint, name_constraint
+
+# Comparison operators that can be resolved using sorted attribute indexes
+_CMP_OPERATORS = {ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+_MIRRORED_CMP = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+def _is_target_attr(node):
+    """True if an expression node is an attribute of the evaluated node (i.e.
+    `@.name`)."""
+    return (isinstance(node, ast.Attribute) and
+            isinstance(node.value, ast.Name) and
+            node.value.id == '__target_node')
+
+def _literal(node):
+    """Returns the value of a literal expression node, or raises ValueError if
+    the expression is not a literal."""
+    return ast.literal_eval(node)
+
+def _constraint_terms(node):
+    """Iterates over all the terms of a conjunctive expression (a and b and
+    ...)."""
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        for value in node.values:
+            for term in _constraint_terms(value):
+                yield term
+    else:
+        yield node
+
+def _term_to_lookup(term):
+    """Translates a simple constraint term into an index lookup, or returns
+    None if the term can only be checked by evaluating it."""
+    # @.children / not @.children
+    if _is_target_attr(term) and term.attr == 'children':
+        return ('leaf', False)
+    # @.is_leaf()
+    if (isinstance(term, ast.Call) and _is_target_attr(term.func) and
+        term.func.attr == 'is_leaf' and not term.args and not term.keywords):
+        return ('leaf', True)
+    if isinstance(term, ast.UnaryOp) and isinstance(term.op, ast.Not):
+        lookup = _term_to_lookup(term.operand)
+        if lookup and lookup[0] == 'leaf':
+            return ('leaf', not lookup[1])
+        return None
+
+    # @.attr == value, value != @.attr, @.attr in (v1, v2), @.attr > value...
+    if not isinstance(term, ast.Compare) or len(term.ops) != 1:
+        return None
+    left, op, right = term.left, term.ops[0], term.comparators[0]
+    if not _is_target_attr(left):
+        if isinstance(op, ast.In) or not _is_target_attr(right):
+            return None
+        left, right = right, left
+        op_name = _CMP_OPERATORS.get(type(op))
+        if op_name:
+            op_name = _MIRRORED_CMP[op_name]
+    else:
+        op_name = _CMP_OPERATORS.get(type(op))
+
+    try:
+        value = _literal(right)
+    except ValueError:
+        return None
+
+    try:
+        if isinstance(op, ast.Eq):
+            hash(value)
+            return ('eq', left.attr, value)
+        elif isinstance(op, ast.NotEq):
+            hash(value)
+            return ('ne', left.attr, value)
+        elif isinstance(op, ast.In) and isinstance(value, (tuple, list, set, frozenset)):
+            return ('in', left.attr, frozenset(value))
+    except TypeError:
+        # unhashable values
+        return None
+
+    if (op_name and isinstance(value, numbers.Real) and
+        not isinstance(value, bool)):
+        return ('cmp', left.attr, op_name, value)
+    return None
+
+def plan_constraint(constraint):
+    """Analyses a constraint expression and finds the conditions that can be
+    answered from the indexes of a TreePatternCache (name or attribute
+    equality, attribute comparisons, leaf or internal nodes).
+
+    :param constraint: python expression as returned by
+        TreePattern.parse_node_name()
+
+    :return: a tuple containing the list of index lookups found and a boolean
+        indicating if those lookups fully replace the evaluation of the
+        constraint.
+    """
+    try:
+        expression = ast.parse(constraint, mode='eval').body
+    except SyntaxError:
+        return [], False
+
+    lookups = []
+    exact = True
+    for term in _constraint_terms(expression):
+        lookup = _term_to_lookup(term)
+        if lookup is None:
+            exact = False
+        else:
+            lookups.append(lookup)
+    return lookups, exact
+
+def _is_target_call(node, func_name):
+    """True if an expression node is a call to a syntax function on the
+    evaluated node (i.e. `func_name(@, ...)`)."""
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+            node.func.id == func_name and len(node.args) >= 1 and
+            isinstance(node.args[0], ast.Name) and
+            node.args[0].id == '__target_node')
+
+def plan_syntax_requirements(constraint):
+    """Finds the conditions of a constraint, based on the default
+    PatternSyntax functions, that a target node can only meet if the whole
+    tree meets them too: the species it must contain
+    (`contains_species(@, [...])` or `"sp" in species(@)`) and its minimum
+    number of leaves (`n_leaves(@) >= n`).
+
+    :return: a tuple with the set of required species and the minimum number
+        of leaves.
+    """
+    try:
+        expression = ast.parse(constraint, mode='eval').body
+    except SyntaxError:
+        return set(), 0
+
+    species = set()
+    min_leaves = 0
+    for term in _constraint_terms(expression):
+        if _is_target_call(term, 'contains_species') and len(term.args) == 2:
+            try:
+                value = _literal(term.args[1])
+            except ValueError:
+                continue
+            if isinstance(value, six.string_types):
+                species.add(value)
+            elif isinstance(value, (tuple, list, set, frozenset)):
+                species.update(value)
+            continue
+
+        if not isinstance(term, ast.Compare) or len(term.ops) != 1:
+            continue
+        left, op, right = term.left, term.ops[0], term.comparators[0]
+        if isinstance(op, ast.In) and _is_target_call(right, 'species'):
+            try:
+                species.add(_literal(left))
+            except (ValueError, TypeError):
+                pass
+            continue
+
+        # n_leaves(@) >= n, n_leaves(@) > n, n_leaves(@) == n, n <= n_leaves(@)...
+        op_name = _CMP_OPERATORS.get(type(op), '==' if isinstance(op, ast.Eq) else None)
+        if _is_target_call(right, 'n_leaves') and op_name:
+            left, right = right, left
+            op_name = _MIRRORED_CMP.get(op_name, op_name)
+        if not _is_target_call(left, 'n_leaves') or op_name not in ('>', '>=', '=='):
+            continue
+        try:
+            value = _literal(right)
+        except ValueError:
+            continue
+        if isinstance(value, numbers.Real) and not isinstance(value, bool):
+            if op_name == '>':
+                value = int(value) + 1
+            min_leaves = max(min_leaves, int(math.ceil(value)))
+    return species, min_leaves
+
+# Element-wise operators of the comparisons that can be vectorized
+_VECTOR_CMP = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+               ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+# Vectorized versions of the constraint expressions seen most recently (None
+# for those that cannot be vectorized)
+_VECTOR_CACHE = _LRUCache(512)
+
+class _NotVectorizable(Exception):
+    pass
+
+def _vector_operand(node):
+    """Translates an operand of a comparison into a function returning its
+    values for all the nodes of a TreePatternCache (or a literal value)."""
+    if _is_target_attr(node):
+        attr_name = node.attr
+        return lambda cache: cache.get_vector(attr_name)
+    # len(@.children)
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+        node.func.id == 'len' and len(node.args) == 1 and not node.keywords and
+        _is_target_attr(node.args[0]) and node.args[0].attr == 'children'):
+        return lambda cache: cache.get_vector('n_children')
+    try:
+        value = _literal(node)
+    except ValueError:
+        raise _NotVectorizable()
+    if isinstance(value, (tuple, list, set, frozenset)):
+        raise _NotVectorizable()
+    return lambda cache: value
+
+def _vector_membership(node):
+    """Translates the right side of an `in` comparison into a set of values."""
+    try:
+        values = _literal(node)
+    except ValueError:
+        raise _NotVectorizable()
+    if not isinstance(values, (tuple, list, set, frozenset)):
+        raise _NotVectorizable()
+    return list(values)
+
+def _as_mask(values):
+    return numpy.asarray(values).astype(bool)
+
+def _vectorize(node):
+    """Translates a constraint expression into a function returning a boolean
+    mask of the nodes of a TreePatternCache satisfying it."""
+    if isinstance(node, ast.BoolOp):
+        functions = [_vectorize(value) for value in node.values]
+        reduce_op = (numpy.logical_and if isinstance(node.op, ast.And)
+                     else numpy.logical_or)
+        return lambda cache: reduce_op.reduce([f(cache) for f in functions])
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        function = _vectorize(node.operand)
+        return lambda cache: ~function(cache)
+
+    # @.children, @.is_leaf()
+    if _is_target_attr(node) and node.attr == 'children':
+        return lambda cache: cache.get_vector('n_children') > 0
+    if (isinstance(node, ast.Call) and _is_target_attr(node.func) and
+        node.func.attr == 'is_leaf' and not node.args and not node.keywords):
+        return lambda cache: cache.get_vector('n_children') == 0
+
+    if isinstance(node, ast.Compare):
+        # chained comparisons (a < @.dist < b) are pairwise conjunctions
+        comparisons = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                values = _vector_operand(left), _vector_membership(right)
+                comparisons.append((type(op), values))
+            elif type(op) in _VECTOR_CMP:
+                values = _vector_operand(left), _vector_operand(right)
+                comparisons.append((_VECTOR_CMP[type(op)], values))
+            else:
+                raise _NotVectorizable()
+            left = right
+
+        def compare(cache):
+            masks = []
+            for op, (a, b) in comparisons:
+                if op in (ast.In, ast.NotIn):
+                    column = a(cache)
+                    if column.dtype == object:
+                        mask = _as_mask([v in b for v in column])
+                    else:
+                        mask = numpy.isin(column, b)
+                    masks.append(~mask if op is ast.NotIn else mask)
+                else:
+                    masks.append(_as_mask(op(a(cache), b(cache))))
+            mask = numpy.logical_and.reduce(masks)
+            if mask.shape != (len(cache.get_node_list()),):
+                # comparison between literals
+                raise _NotVectorizable()
+            return mask
+        return compare
+
+    try:
+        value = _literal(node)
+    except ValueError:
+        raise _NotVectorizable()
+    return lambda cache: numpy.full(len(cache.get_node_list()), bool(value))
+
+def vectorize_constraint(constraint):
+    """Translates a constraint into a function evaluating it over all the
+    nodes of a TreePatternCache at once, as NumPy operations over its attribute
+    columns. Only comparisons and boolean combinations of node attributes,
+    literals, `@.is_leaf()`, `@.children` and `len(@.children)` are
+    supported.
+
+    :param constraint: python expression as returned by
+        TreePattern.parse_node_name()
+
+    :return: a function returning a boolean array with the result of the
+        constraint for every node id, or None if the constraint cannot be
+        vectorized (or NumPy is not available).
+    """
+    if numpy is None:
+        return None
+    if constraint in _VECTOR_CACHE:
+        return _VECTOR_CACHE[constraint]
+    try:
+        expression = ast.parse(constraint, mode='eval').body
+        vectorized = _vectorize(expression)
+    except (SyntaxError, _NotVectorizable):
+        vectorized = None
+    _VECTOR_CACHE[constraint] = vectorized
+    return vectorized
+
+def _popcount(mask):
+    """ Number of bits set in an integer. """
+    return bin(mask).count('1')
+
+def _bits(mask):
+    """ Iterates over the positions of the bits set in an integer. """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+class _NodeIndex(object):
+    """ Hash and sorted indexes of the attributes of the nodes of a tree,
+    used to resolve the lookups found by plan_constraint(). Requires
+    get_nodes(), get_leaf_nodes(), get_internal_nodes(), _iter_attr() and the
+    _attr_indexes and _sorted_attr_indexes dictionaries. """
+
+    def get_attr_index(self, attr_name):
+        """
+        Returns a hash index of the nodes in the tree by the value of a given
+        attribute.
+
+        :param attr_name: any node attribute (e.g., name, species, dist, etc.)
+
+        :return: a dictionary of attribute values and their sets of nodes, or
+          None if the attribute is missing in some nodes or its values cannot
+          be hashed.
+        """
+        if attr_name not in self._attr_indexes:
+            index = defaultdict(set)
+            try:
+                for n, value in self._iter_attr(attr_name):
+                    index[value].add(n)
+            except Exception:
+                index = None
+            self._attr_indexes[attr_name] = index
+        return self._attr_indexes[attr_name]
+
+    def get_sorted_attr_index(self, attr_name):
+        """
+        Returns the nodes in the tree sorted by the value of a numeric
+        attribute.
+
+        :param attr_name: any numeric node attribute (e.g., dist, support, etc.)
+
+        :return: a tuple with the sorted list of values and the list of nodes
+          in the same order, or None if the attribute is missing or not numeric
+          in some nodes. Nodes with NaN values are excluded.
+        """
+        if attr_name not in self._sorted_attr_indexes:
+            index = self.get_attr_index(attr_name)
+            if index is not None and all(isinstance(v, numbers.Real)
+                                         for v in index):
+                values, nodes = [], []
+                for v in sorted(v for v in index if v == v):
+                    for n in index[v]:
+                        values.append(v)
+                        nodes.append(n)
+                self._sorted_attr_indexes[attr_name] = (values, nodes)
+            else:
+                self._sorted_attr_indexes[attr_name] = None
+        return self._sorted_attr_indexes[attr_name]
+
+    def find_nodes(self, lookup):
+        """
+        Resolves an index lookup as produced by plan_constraint().
+
+        :return: the set of nodes satisfying the lookup (which should not be
+          modified), or None if it cannot be resolved using indexes.
+        """
+        kind = lookup[0]
+        if kind == 'leaf':
+            return self.get_leaf_nodes() if lookup[1] else self.get_internal_nodes()
+
+        attr_name = lookup[1]
+        if kind == 'cmp':
+            index = self.get_sorted_attr_index(attr_name)
+            if index is None:
+                return None
+            values, nodes = index
+            op, value = lookup[2], lookup[3]
+            if op == '>':
+                return set(nodes[bisect.bisect_right(values, value):])
+            elif op == '>=':
+                return set(nodes[bisect.bisect_left(values, value):])
+            elif op == '<':
+                return set(nodes[:bisect.bisect_left(values, value)])
+            else:
+                return set(nodes[:bisect.bisect_right(values, value)])
+
+        index = self.get_attr_index(attr_name)
+        if index is None:
+            return None
+        if kind == 'eq':
+            return index.get(lookup[2], set())
+        elif kind == 'ne':
+            return self.get_nodes() - index.get(lookup[2], set())
+        elif kind == 'in':
+            found = set()
+            for value in lookup[2]:
+                found.update(index.get(value, ()))
+            return found
+        return None
+
+
+class LCAIndex(object):
+    def __init__(self, tree):
+        """ Ancestry and lowest common ancestor queries over a tree in constant
+        time. Nodes are numbered in preorder, so the descendants of a node are
+        the nodes numbered from it to the end of its subtree, and ancestry
+        between two nodes is tested comparing numbers.
+
+        Common ancestors use a sparse table of the shallowest node of every
+        range of preorder numbers, which takes O(n log n) memory, so it is
+        only built the first time a common ancestor is requested.
+
+        It is built once per tree and can be shared by any number of searches
+        (see TreePatternCache.get_lca_index).
+
+        :param tree: a regular ETE tree instance
+        """
+        self.tree = tree
+        # nodes in preorder, and the number, subtree size and depth of every
+        # node (by number)
+        self.nodes = []
+        self.preorder = {}
+        self.sizes = array('l')
+        self.depths = array('l')
+        to_visit = [(tree, 0)]
+        while to_visit:
+            node, depth = to_visit.pop()
+            self.preorder[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.sizes.append(1)
+            self.depths.append(depth)
+            to_visit.extend((ch, depth + 1) for ch in reversed(node.children))
+        for i in range(len(self.nodes) - 1, 0, -1):
+            node = self.nodes[i]
+            self.sizes[self.preorder[node.up]] += self.sizes[i]
+        self._sparse = None
+
+    def _get_sparse_table(self):
+        """ Returns the sparse table where sparse[k][i] is the number of the
+        shallowest node between the numbers i and i + 2**k - 1. """
+        if self._sparse is None:
+            depths = self.depths
+            sparse = [array('l', range(len(depths)))]
+            k = 1
+            while (1 << k) <= len(depths):
+                prev = sparse[-1]
+                half = 1 << (k - 1)
+                level = array('l', [0]) * (len(depths) - (1 << k) + 1)
+                for i in range(len(level)):
+                    a, b = prev[i], prev[i + half]
+                    level[i] = a if depths[a] <= depths[b] else b
+                sparse.append(level)
+                k += 1
+            self._sparse = sparse
+        return self._sparse
+
+    def get_common_ancestor(self, nodes):
+        """ Returns the lowest common ancestor of a list of nodes. """
+        numbers = [self.preorder[n] for n in nodes]
+        start, end = min(numbers), max(numbers)
+        if end < start + self.sizes[start]:
+            return self.nodes[start]
+        # the shallowest nodes after the first one and up to the last one are
+        # children of their common ancestor
+        sparse = self._get_sparse_table()
+        k = (end - start).bit_length() - 1
+        a, b = sparse[k][start + 1], sparse[k][end - (1 << k) + 1]
+        return self.nodes[a if self.depths[a] <= self.depths[b] else b].up
+
+    def is_ancestor(self, ancestor, node):
+        """ Returns True if ancestor is node or any of its ancestors. """
+        i = self.preorder[ancestor]
+        return i <= self.preorder[node] < i + self.sizes[i]
+
+    def get_depth(self, node):
+        """ Returns the number of edges between a node and the root. """
+        return self.depths[self.preorder[node]]
+
+
+class _NodeSubset(_NodeIndex):
+    """ Index of some nodes of a tree, used to evaluate constraints only on
+    them (see MatchSession). """
+
+    def __init__(self, nodes):
+        self._nodes = set(nodes)
+        self._leaves = set(n for n in self._nodes if not n.children)
+        self._internal_nodes = self._nodes - self._leaves
+        self._attr_indexes = {}
+        self._sorted_attr_indexes = {}
+
+    def get_nodes(self):
+        return self._nodes
+
+    def get_leaf_nodes(self):
+        return self._leaves
+
+    def get_internal_nodes(self):
+        return self._internal_nodes
+
+    def _iter_attr(self, attr_name):
+        for n in self._nodes:
+            yield n, getattr(n, attr_name)
+
+class TreePatternCache(_NodeIndex):
     def __init__(self, tree):
         """ Creates a cache for attributes that require multiple tree
-        traversal when using complex TreePattern queries.
+        traversal when using complex TreePattern queries. Content is computed
+        the first time it is needed.
 
         :param tree: a regular ETE tree instance
          """
-        # Initialize cache (add more stuff as needed)
-        self.leaves_cache = tree.get_cached_content()
-        self.all_node_cache = tree.get_cached_content(leaves_only=False)
+        self.tree = tree
+        self._preorder = None
+        self._node_list = None
+        self._vectors = {}
+        self._leaves_cache = None
+        self._all_node_cache = None
+        self._nodes = None
+        self._leaves = None
+        self._internal_nodes = None
+        self._attr_indexes = {}
+        self._sorted_attr_indexes = {}
+        self._aggregates = None
+        self._lca_index = None
+        self.species2id = None
+        self.id2species = None
+
+    @property
+    def leaves_cache(self):
+        if self._leaves_cache is None:
+            self._leaves_cache = self.tree.get_cached_content()
+        return self._leaves_cache
+
+    @property
+    def all_node_cache(self):
+        if self._all_node_cache is None:
+            self._all_node_cache = self.tree.get_cached_content(leaves_only=False)
+        return self._all_node_cache
+
+    def get_nodes(self):
+        """ Returns the set of all nodes in the tree. """
+        if self._nodes is None:
+            self._nodes = set(self.tree.traverse())
+        return self._nodes
+
+    def get_leaf_nodes(self):
+        """ Returns the set of nodes without children. """
+        if self._leaves is None:
+            self._leaves = set(n for n in self.get_nodes() if not n.children)
+        return self._leaves
+
+    def get_internal_nodes(self):
+        """ Returns the set of nodes with children. """
+        if self._internal_nodes is None:
+            self._internal_nodes = self.get_nodes() - self.get_leaf_nodes()
+        return self._internal_nodes
+
+    def _iter_attr(self, attr_name):
+        for n in self.get_nodes():
+            yield n, getattr(n, attr_name)
 
     def get_cached_attr(self, attr_name, node, leaves_only=False):
         """
@@ -45,6 +741,319 @@ class TreePatternCache(object):
     def get_descendants(self, node):
         return self.all_node_cache[node]
 
+    def get_preorder(self):
+        """ Returns the list of nodes of the tree in preorder, and an array
+        with the position in that list of the parent of every node (-1 for
+        the root). """
+        if self._preorder is None:
+            nodes = []
+            parent = array('l')
+            to_visit = [(self.tree, -1)]
+            while to_visit:
+                node, parent_id = to_visit.pop()
+                parent.append(parent_id)
+                to_visit.extend((ch, len(nodes)) for ch in reversed(node.children))
+                nodes.append(node)
+            self._preorder = (nodes, parent)
+        return self._preorder
+
+    def get_node_list(self):
+        """ Returns the list of all nodes in the tree, in the order of the
+        values returned by get_vector(). """
+        if self._node_list is None:
+            self._node_list = list(self.get_nodes())
+        return self._node_list
+
+    def get_vector(self, attr_name):
+        """ Returns the values of an attribute for all nodes (see
+        get_node_list) as a NumPy array (requires NumPy). Numeric values of
+        dist and support are stored as floats, and 'n_children' returns the
+        number of children of every node. """
+        if attr_name not in self._vectors:
+            nodes = self.get_node_list()
+            if attr_name == 'n_children':
+                vector = numpy.array([len(n.children) for n in nodes])
+            else:
+                values = [getattr(n, attr_name) for n in nodes]
+                vector = None
+                if attr_name in ('dist', 'support'):
+                    try:
+                        vector = numpy.frombuffer(array('d', values), dtype=float)
+                    except TypeError:
+                        pass
+                if vector is None:
+                    vector = numpy.empty(len(values), dtype=object)
+                    vector[:] = values
+            self._vectors[attr_name] = vector
+        return self._vectors[attr_name]
+
+    def get_lca_index(self):
+        """ Returns the LCAIndex of the tree. """
+        if self._lca_index is None:
+            self._lca_index = LCAIndex(self.tree)
+        return self._lca_index
+
+    def get_common_ancestor(self, nodes):
+        """ Returns the lowest common ancestor of a list of nodes. """
+        return self.get_lca_index().get_common_ancestor(nodes)
+
+    def is_ancestor(self, ancestor, node):
+        """ Returns True if ancestor is node or any of its ancestors. """
+        return self.get_lca_index().is_ancestor(ancestor, node)
+
+    def _get_aggregates(self):
+        """ Computes, in a single post-order traversal, the number of leaves, the
+        species and the number of duplication and speciation events under
+        every node of the tree.
+
+        Species are encoded as bitmasks: every species in the tree gets an
+        integer id, and the species under a node are represented by an integer
+        with the bits of their ids set, so subset tests and cardinality become
+        bitwise operations. """
+        if self._aggregates is None:
+            self.species2id = {}
+            self.id2species = []
+            self._species_sets = {}
+            self._aggregates = ({}, {}, {}, {'D': {}, 'S': {}})
+            self._add_aggregates(self.tree.traverse('postorder'))
+        return self._aggregates
+
+    def _add_aggregates(self, nodes):
+        """ Computes the aggregates of some nodes from the ones of their
+        children, which should come first (e.g., nodes in postorder). """
+        n_leaves, species_masks, n_species, n_events = self._aggregates
+        species2id = self.species2id
+        for n in nodes:
+            if n.children:
+                n_leaves[n] = sum(n_leaves[ch] for ch in n.children)
+                mask = 0
+                for ch in n.children:
+                    mask |= species_masks[ch]
+            else:
+                n_leaves[n] = 1
+                sp = getattr(n, 'species', None)
+                if sp not in species2id:
+                    species2id[sp] = len(species2id)
+                    self.id2species.append(sp)
+                mask = 1 << species2id[sp]
+            species_masks[n] = mask
+            n_species[n] = _popcount(mask)
+
+            evoltype = getattr(n, 'evoltype', None)
+            for event, counts in six.iteritems(n_events):
+                counts[n] = sum(counts[ch] for ch in n.children)
+                if evoltype == event:
+                    counts[n] += 1
+
+    def _set_aggregates(self, nodes, parent):
+        """ Computes the aggregates of all nodes, as _get_aggregates() does, from
+        the nodes in preorder and the id of the parent of every node, adding
+        the values of every node to its parent in a single loop over the ids.
+        """
+        n_duplications = [0] * len(nodes)
+        n_speciations = [0] * len(nodes)
+        n_events = {'D': n_duplications, 'S': n_speciations}
+        n_leaves = [0] * len(nodes)
+        species_masks = [0] * len(nodes)
+        self.species2id = species2id = {}
+        self.id2species = []
+        self._species_sets = {}
+        for node_id in range(len(nodes) - 1, -1, -1):
+            node = nodes[node_id]
+            if not node.children:
+                n_leaves[node_id] = 1
+                sp = getattr(node, 'species', None)
+                if sp not in species2id:
+                    species2id[sp] = len(species2id)
+                    self.id2species.append(sp)
+                species_masks[node_id] |= 1 << species2id[sp]
+            counts = n_events.get(getattr(node, 'evoltype', None))
+            if counts is not None:
+                counts[node_id] += 1
+            parent_id = parent[node_id]
+            if parent_id >= 0:
+                n_leaves[parent_id] += n_leaves[node_id]
+                species_masks[parent_id] |= species_masks[node_id]
+                n_duplications[parent_id] += n_duplications[node_id]
+                n_speciations[parent_id] += n_speciations[node_id]
+        self._aggregates = (
+            dict(zip(nodes, n_leaves)),
+            dict(zip(nodes, species_masks)),
+            dict(zip(nodes, [_popcount(mask) for mask in species_masks])),
+            dict((event, dict(zip(nodes, counts)))
+                 for event, counts in six.iteritems(n_events)))
+
+    def update(self, nodes, removed=()):
+        """ Updates the cache after the tree is edited. Indexes over the whole
+        tree are rebuilt the next time they are needed, while the content
+        (leaves, descendants, species and events) of the nodes in the tree is
+        only recomputed for the nodes given.
+
+        :param nodes: the nodes whose attributes or descendants changed, with
+            all their ancestors, sorted so that children come before their
+            parents (e.g., in postorder).
+        :param removed: the nodes no longer in the tree.
+        """
+        self._preorder = None
+        self._node_list = None
+        self._vectors = {}
+        self._nodes = self._leaves = self._internal_nodes = None
+        self._attr_indexes = {}
+        self._sorted_attr_indexes = {}
+        self._lca_index = None
+
+        nodes = list(nodes)
+        for content, leaves_only in [(self._leaves_cache, True),
+                                     (self._all_node_cache, False)]:
+            if content is None:
+                continue
+            for n in removed:
+                content.pop(n, None)
+            for n in nodes:
+                node_content = set() if n.children and leaves_only else set([n])
+                for ch in n.children:
+                    node_content.update(content[ch])
+                content[n] = node_content
+
+        if self._aggregates is not None:
+            n_leaves, species_masks, n_species, n_events = self._aggregates
+            for values in [n_leaves, species_masks, n_species] + list(n_events.values()):
+                for n in removed:
+                    values.pop(n, None)
+            self._add_aggregates(nodes)
+
+    def get_n_leaves(self, node):
+        """ Returns the number of leaves under a node. """
+        return self._get_aggregates()[0][node]
+
+    def get_species_mask(self, node):
+        """ Returns the bitmask encoding the species found in the leaves under
+        a node (see species2id for the id of each species). """
+        return self._get_aggregates()[1][node]
+
+    def get_species(self, node):
+        """ Returns the frozenset of species found in the leaves under a node
+        (shared among nodes with the same species content). """
+        mask = self.get_species_mask(node)
+        species = self._species_sets.get(mask)
+        if species is None:
+            species = frozenset(self.id2species[i] for i in _bits(mask))
+            self._species_sets[mask] = species
+        return species
+
+    def get_n_species(self, node):
+        """ Returns the number of species found in the leaves under a node. """
+        return self._get_aggregates()[2][node]
+
+    def has_species(self, node, species_names):
+        """ Returns True if all the species provided are found in the leaves
+        under a node. """
+        mask = self.get_species_mask(node)
+        required = 0
+        for sp in species_names:
+            if sp not in self.species2id:
+                return False
+            required |= 1 << self.species2id[sp]
+        return mask & required == required
+
+    def get_n_events(self, node, evoltype):
+        """ Returns the number of nodes at or below a node whose evoltype
+        attribute is 'D' (duplications) or 'S' (speciations). """
+        return self._get_aggregates()[3][evoltype][node]
+
+    def get_state(self):
+        """ Returns the tree as a dictionary of plain python objects and
+        arrays, which can be pickled and turned back into a tree and its cache
+        with load_tree_cache(), faster than parsing and indexing it again.
+
+        Nodes are stored in preorder with the id of their parent, their name,
+        dist, support, species and any other feature. The number of leaves,
+        species and events under every node are not stored, as they are
+        computed from these arrays in a fraction of the loading time.
+        """
+        nodes, parent = self.get_preorder()
+        features = {}
+        for node_id, node in enumerate(nodes):
+            for name in node.features - TREE_STATE_FEATURES:
+                features.setdefault(name, {})[node_id] = getattr(node, name)
+        species_table = []
+        species2id = {}
+        species = array('i')
+        for node in nodes:
+            sp = getattr(node, 'species', None)
+            if sp not in species2id:
+                species2id[sp] = len(species_table)
+                species_table.append(sp)
+            species.append(species2id[sp])
+        return {
+            'version': TREE_STATE_VERSION,
+            'phylo': isinstance(self.tree, PhyloTree),
+            'parent': array('i', parent),
+            'name': [node.name for node in nodes],
+            'dist': array('d', [node.dist for node in nodes]),
+            'support': array('d', [node.support for node in nodes]),
+            'features': features,
+            'species_table': species_table,
+            'species': species,
+            # nodes that write their species with their features (e.g., the
+            # leaves of a PhyloTree)
+            'species_feature': array('i', [node_id for node_id, node in enumerate(nodes)
+                                           if 'species' in node.features]),
+        }
+
+
+# version of the format returned by TreePatternCache.get_state()
+TREE_STATE_VERSION = 2
+
+# node attributes stored in their own field of the tree states
+TREE_STATE_FEATURES = frozenset(['name', 'dist', 'support', 'species'])
+
+def load_tree_cache(state):
+    """ Rebuilds a tree and its TreePatternCache from the state returned by
+    TreePatternCache.get_state().
+
+    The species of PhyloTree nodes are restored as plain values, as they were
+    when the state was saved, instead of being computed from node names.
+
+    :return: a TreePatternCache instance, whose tree attribute is the target
+        tree.
+    """
+    if state.get('version') != TREE_STATE_VERSION:
+        raise ValueError("Unsupported tree state version: %s" % state.get('version'))
+
+    # no garbage can be collected while creating the nodes, but the linked
+    # nodes would make the collector traverse the whole tree over and over
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        node_class = PhyloTree if state['phylo'] else Tree
+        names, dists, supports = state['name'], state['dist'], state['support']
+        parent = state['parent']
+        nodes = []
+        for node_id, parent_id in enumerate(parent):
+            node = node_class(name=names[node_id], dist=dists[node_id],
+                              support=supports[node_id])
+            if parent_id >= 0:
+                nodes[parent_id].add_child(node)
+            nodes.append(node)
+        species_table, species = state['species_table'], state['species']
+        if state['phylo']:
+            for node, species_id in zip(nodes, species):
+                node.species = species_table[species_id]
+        for node_id in state['species_feature']:
+            nodes[node_id].add_feature('species', species_table[species[node_id]])
+        for name, values in six.iteritems(state['features']):
+            for node_id, value in six.iteritems(values):
+                nodes[node_id].add_feature(name, value)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    cache = TreePatternCache(nodes[0])
+    cache._preorder = (nodes, parent)
+    cache._set_aggregates(nodes, parent)
+    return cache
+
 
 class _FakeCache(object):
     """TreePattern cache emulator."""
@@ -69,6 +1078,35 @@ class _FakeCache(object):
     def get_descendants(self, node):
         return node.get_descendants()
 
+    def get_n_leaves(self, node):
+        return len(node.get_leaves())
+
+    def get_species(self, node):
+        return frozenset(getattr(n, 'species', None) for n in node.iter_leaves())
+
+    def get_n_species(self, node):
+        return len(self.get_species(node))
+
+    def has_species(self, node, species_names):
+        return set(species_names) <= self.get_species(node)
+
+    def get_n_events(self, node, evoltype):
+        return sum(1 for n in node.traverse()
+                   if getattr(n, 'evoltype', None) == evoltype)
+
+    def get_common_ancestor(self, nodes):
+        nodes = list(nodes)
+        if len(nodes) == 1:
+            return nodes[0]
+        return nodes[0].get_common_ancestor(nodes[1:])
+
+    def is_ancestor(self, ancestor, node):
+        while node is not None:
+            if node is ancestor:
+                return True
+            node = node.up
+        return False
+
 
 class PatternSyntax(object):
     def __init__(self):
@@ -97,8 +1135,7 @@ class PatternSyntax(object):
             'name', target_node)])
 
     def species(self, target_node):
-        return set([name for name in self.cache.get_cached_attr(
-            'species', target_node, leaves_only=True)])
+        return self.cache.get_species(target_node)
 
     def contains_species(self, target_node, species_names):
         """
@@ -109,11 +1146,7 @@ class PatternSyntax(object):
         else:
             species_names = set(species_names)
 
-        found = 0
-        for sp in self.cache.get_cached_attr('species', target_node, leaves_only=True):
-            if sp in species_names:
-                found += 1
-        return found == len(species_names)
+        return self.cache.has_species(target_node, species_names)
 
     def contains_leaves(self, target_node, node_names):
         """ Shortcut function to find if a node contains at least one of the
@@ -134,13 +1167,12 @@ class PatternSyntax(object):
         """ Shortcut function to find the number of species within a node and
         any of it's descendants. """
 
-        species = self.cache.get_cached_attr('species', target_node, leaves_only=True)
-        return len(set(species))
+        return self.cache.get_n_species(target_node)
 
     def n_leaves(self, target_node):
         """ Shortcut function to find the number of leaves within a node and any
                 of it's descendants. """
-        return len(self.cache.get_leaves(target_node))
+        return self.cache.get_n_leaves(target_node)
 
     def n_duplications(self, target_node):
         """
@@ -148,17 +1180,164 @@ class PatternSyntax(object):
             :param target_node: Node to be evaluated, given as @.
             :return: True if node is a duplication, otherwise False.
         """
-        events = self.cache.get_cached_attr('evoltype', target_node)
-        return(events.count('D'))
+        return self.cache.get_n_events(target_node, 'D')
 
     def n_speciations(self, target_node):
         """
             Shortcut function to find the number of speciation events at or below a node.
         """
-        events = self.cache.get_cached_attr('evoltype', target_node)
-        return(events.count('S'))
+        return self.cache.get_n_events(target_node, 'S')
+
+    def is_ancestor(self, target_node, node):
+        """
+            Shortcut function to find if a node is the target node or any of its
+            descendants.
+        """
+        return self.cache.is_ancestor(target_node, node)
+
+    def common_ancestor(self, *nodes):
+        """
+            Shortcut function to find the lowest common ancestor of the nodes provided.
+        """
+        return self.cache.get_common_ancestor(nodes)
+
+class _LocalMatcher(object):
+    """ Evaluation of the constraints of a pattern node over the nodes of a
+    target tree. Requires the attributes set by TreePattern.init_controller()
+    (or by CompiledPatternNode). """
+
+    def is_local_match(self, target_node, cache, scopes=None):
+        """ Evaluate if a tree nodes matches the constraints in this pattern node.
+
+        :param None scopes: the constraint scopes of the current search, as
+            returned by CompiledPattern.get_scopes(). By default, the scopes
+            prepared by init_controller() are used.
+        """
+
+        # Fast path for plain node names: no need to evaluate the constraint
+        if self.name_constraint is not None:
+            if target_node.name != self.name_constraint:
+                return False
+            return bool(target_node.children) != self.terminal
+
+        # The local scope containing function names, variables and other stuff
+        # referred within the pattern expressions is built once when the
+        # pattern is prepared (or per search). Only the target node needs to
+        # be updated.
+        if scopes is None:
+            constraint_scope = self.constraint_scope
+        else:
+            constraint_scope = scopes[id(self.syntax)]
+        constraint_scope["__target_node"] = target_node
+
+        try:
+            if self.constraint:
+                st = eval(self.compiled_constraint, constraint_scope)
+            else:
+                st = True
+
+        except ValueError:
+            raise ValueError("not a boolean result: . Check quoted_node_names.")
+
+        except (AttributeError, IndexError) as err:
+            raise ValueError('Constraint evaluation failed at %s: %s' %
+                             (target_node, err))
+        except NameError:
+            try:
+                # temporary fix. Can not access custom syntax on all nodes. Get it from the root node.
+                if scopes is None:
+                    constraint_scope = self.root_constraint_scope
+                else:
+                    constraint_scope = scopes[id(self.root_syntax)]
+                constraint_scope["__target_node"] = target_node
+
+                return eval(self.compiled_constraint, constraint_scope)
+            except NameError as err:
+                raise NameError('Constraint evaluation failed at %s: %s' %
+                         (target_node, err))
+        else:
+            return st
+
+    def find_candidates(self, cache):
+        """ Resolves the parts of the constraint in this pattern node that can
+        be answered from the indexes of a TreePatternCache.
 
-class TreePattern(Tree):
+        :return: a tuple with the set of candidate nodes (which should not be
+            modified) and a boolean indicating if all candidates are matches
+            (otherwise, the constraint needs to be evaluated on them).
+        """
+        exact = self.exact_lookups
+        found = []
+        for lookup in self.index_lookups:
+            nodes = cache.find_nodes(lookup)
+            if nodes is None:
+                exact = False
+            else:
+                found.append(nodes)
+
+        if not found:
+            return cache.get_nodes(), exact
+
+        found.sort(key=len)
+        candidates = found[0]
+        if len(found) > 1:
+            candidates = set(candidates)
+            for nodes in found[1:]:
+                candidates &= nodes
+        return candidates, exact
+
+    def find_vectorized_matches(self, index):
+        """ Evaluates the constraint in this pattern node over all nodes of a
+        TreePatternCache at once (see vectorize_constraint).
+
+        :return: the set of matching nodes, or None if the constraint (or
+            the attributes of the tree) cannot be vectorized, so it needs to
+            be evaluated node by node.
+        """
+        if not isinstance(index, TreePatternCache):
+            return None
+        vectorized = vectorize_constraint(self.constraint)
+        # len() could be redefined by a custom syntax
+        if vectorized is None or hasattr(self.syntax, 'len'):
+            return None
+        try:
+            mask = vectorized(index)
+        except Exception:
+            return None
+        nodes = index.get_node_list()
+        return set(nodes[i] for i in numpy.flatnonzero(mask).tolist())
+
+    def find_local_matches(self, cache, stats=None, scopes=None):
+        """ Returns the set of nodes in a tree matching the constraints in this
+        pattern node.
+
+        :param cache: a TreePatternCache instance of the target tree, used to
+            resolve simple constraints from its indexes. Only the candidate
+            nodes found through indexes are evaluated, and only when the
+            constraint is too complex to be fully answered by the indexes.
+            Constraints on node attributes are evaluated over all nodes at
+            once (see vectorize_constraint).
+        :param stats: optional SearchStats instance recording the candidates
+            and constraint evaluations.
+        :param scopes: the constraint scopes of the search (see
+            is_local_match).
+        """
+        candidates, exact = self.find_candidates(cache)
+        if not exact:
+            found = self.find_vectorized_matches(cache)
+            if found is not None:
+                candidates, exact = found, True
+        if stats is not None:
+            stats.add_candidates(self.constraint, len(candidates))
+        if exact:
+            return set(candidates)
+        is_local_match = partial(self.is_local_match, scopes=scopes)
+        if stats is not None:
+            is_local_match = stats.counted(is_local_match)
+        return set(n for n in candidates if is_local_match(n, cache))
+
+
+class TreePattern(Tree, _LocalMatcher):
     def __str__(self):
         return self.get_ascii(show_internal=True, attributes=["name"])
 
@@ -193,134 +1372,1127 @@ class TreePattern(Tree):
         the end of the string.
 
         """
-        raw_constraint = raw_constraint.strip()
-        if raw_constraint.endswith('+'):
-            self.min_occur = 1
-            self.max_occur = 9999999
-            raw_constraint = raw_constraint[:-1]
-        elif raw_constraint.endswith('*'):
-            self.min_occur = 0
-            self.max_occur = 9999999
-            raw_constraint = raw_constraint[:-1]
-        elif raw_constraint.endswith('}'):
-            exp = '\{\s*(\d+)\s*,\s*(\d+)\s*\}'
-            s = re.search(exp, raw_constraint)
-            if s:
-                minv, maxv = map(int, s.groups())
-                self.min_occur = minv
-                self.max_occur = maxv
-                raw_constraint = re.sub(exp, '', raw_constraint)
-            else:
-                self.min_occur = 1
-                self.max_occur = 1
-
-        else:
-            self.min_occur = 1
-            self.max_occur = 1
-
-        if raw_constraint.startswith('^') and self.children:
-            self.loose_children = True
-            raw_constraint = raw_constraint[1:]
-        else:
-            self.loose_children = False
-
-        return raw_constraint.strip()
+        (clean_constraint, self.min_occur, self.max_occur,
+         self.loose_children) = parse_metacharacters(raw_constraint,
+                                                     bool(self.children))
+        return clean_constraint
 
     def parse_node_name(self):
         """transforms node.name into an evaluable python expression. Metachars are also
         extracted and parsed as min and max occurrence information.
         """
         clean_name = self.parse_metacharacters(self.name)
-
-        # Translate alias and shortcut expressions in clean names
-        if '@' not in clean_name:
-            constraint = '__target_node.name == "%s"' %clean_name
-        elif clean_name:
-            constraint = clean_name.replace('@', '__target_node')
-        else:
-            constraint = 'True'
-
-        if self.children:
-            constraint = '(%s) and __target_node.children' %constraint
-        else:
-            constraint = '(%s) and not __target_node.children' %constraint
-
+        constraint, self.name_constraint = build_constraint(clean_name,
+                                                            bool(self.children))
         return constraint
 
-    def init_controller(self):
+    def init_controller(self, scopes=None):
         """
         Creates a dictionary that contains information about a node.
         That information is about how a node interacts with the tree topology.
         It describes how the metacharacter connects with the rest of nodes and
         if it is leaf or root.
+
+        :param scopes: a dictionary of constraint scopes already built for
+            other nodes of the same pattern, indexed by syntax object, so
+            nodes sharing a syntax controller share the same scope.
         """
         # Interpret node name to python expression
         self.constraint = self.parse_node_name()
+        self.terminal = not self.children
+        # and compile it, so it is not parsed again for every target node
+        self.compiled_constraint = compile_constraint(self.constraint)
+        # Find out which parts of the constraint can be answered from indexes
+        self.index_lookups, self.exact_lookups = plan_constraint(self.constraint)
+
+        # Prepare the scopes used to evaluate the constraint. The custom
+        # syntax set in the root node is used as fallback
+        if scopes is None:
+            scopes = {}
+        root_syntax = self.get_tree_root().syntax
+        for syntax in (self.syntax, root_syntax):
+            if id(syntax) not in scopes:
+                scopes[id(syntax)] = build_constraint_scope(syntax)
+        self.constraint_scope = scopes[id(self.syntax)]
+        self.root_constraint_scope = scopes[id(root_syntax)]
+
+    def compile(self):
+        """ Returns a CompiledPattern of this pattern, which can be used to
+        search in any number of trees without copying or modifying this
+        pattern. """
+        return CompiledPattern(self)
+
+    def find_match(self, t, cache=None, stats=None, budget=None):
+        """ Iterate over all matches of this pattern in a tree.
+
+        :param t: the target tree
+        :param cache: optional TreePatternCache of the target tree, which can
+            be shared by many patterns searched in the same tree.
+        :param stats: optional SearchStats instance to profile the search.
+        :param budget: optional SearchBudget limiting the search.
+        """
+        return find_matches(t, self, cache, stats, budget)
+
+    def exists(self, t, cache=None, stats=None, budget=None):
+        """ Returns True if this pattern matches a tree, stopping the search at
+        the first match found. """
+        return pattern_exists(t, self, cache, stats, budget)
+
+    def count(self, t, cache=None, stats=None, budget=None):
+        """ Returns the number of matches of this pattern in a tree. """
+        return count_matches(t, self, cache, stats, budget)
+
+
+class CompiledPatternNode(_LocalMatcher):
+    """ Node of a CompiledPattern, holding the parsed constraint, occurrence
+    bounds and strict children of a pattern node. Children connected through
+    loose connections are not included, as they are matched as independent
+    sub-patterns. """
+
+    def __init__(self, pattern_node, syntaxes, root_syntax, syntax_keys):
+        self.name = pattern_node.name
+        (clean_name, self.min_occur, self.max_occur,
+         self.loose_children) = parse_metacharacters(pattern_node.name,
+                                                     bool(pattern_node.children))
+        self.constraint, self.name_constraint = build_constraint(
+            clean_name, bool(pattern_node.children))
+        self.terminal = not pattern_node.children
+        self.compiled_constraint = compile_constraint(self.constraint)
+        self.index_lookups, self.exact_lookups = plan_constraint(self.constraint)
+        # constraint scopes are built from these syntax controllers for every
+        # search (see CompiledPattern.get_scopes)
+        self.syntax = syntaxes[id(pattern_node.syntax)]
+        self.root_syntax = syntaxes[id(root_syntax)]
+        self.children = []
+        # Nodes with the same key are known to match the same target nodes
+        self.key = (self.constraint, syntax_keys[id(pattern_node.syntax)],
+                    syntax_keys[id(root_syntax)])
 
+    def __repr__(self):
+        return "Compiled pattern node '%s' (%s)" %(self.name, hex(id(self)))
 
-    def is_local_match(self, target_node, cache):
-        """ Evaluate if a tree nodes matches the constraints in this pattern node.  """
 
-        # Creates a local scope containing function names, variables and other
-        # stuff referred within the pattern expressions. We use Syntax() as a
-        # container of those custom functions and shortcuts.
-        constraint_scope = {attr_name: getattr(self.syntax, attr_name)
-                            for attr_name in dir(self.syntax)}
-        constraint_scope.update({"__target_node": target_node})
+class CompiledPattern(object):
+    def __init__(self, pattern):
+        """ Creates an immutable representation of a TreePattern, with all its
+        constraints parsed and compiled and its loose connections split, that
+        can be matched against any number of trees. The original pattern is
+        not modified.
 
-        try:
-            if self.constraint:
-                st = eval(self.constraint, constraint_scope)
+        :param pattern: a TreePattern instance
+        """
+        root_syntax = pattern.syntax
+
+        # Private copies of the syntax controllers, so the original pattern is
+        # not modified. Every search copies them again to attach the cache of
+        # its target tree (see get_scopes).
+        self.syntaxes = []
+        syntaxes = {}
+        syntax_keys = {}
+        for pnode in pattern.traverse():
+            if id(pnode.syntax) not in syntaxes:
+                syntax = copy(pnode.syntax)
+                self.syntaxes.append(syntax)
+                syntaxes[id(pnode.syntax)] = syntax
+                # All default syntax controllers are equivalent
+                if type(pnode.syntax) is PatternSyntax:
+                    syntax_keys[id(pnode.syntax)] = PatternSyntax
+                else:
+                    syntax_keys[id(pnode.syntax)] = id(pnode.syntax)
+
+        # Compile all nodes (in preorder), keeping the original topology
+        pnode2node = {}
+        all_children = defaultdict(list)
+        self.nodes = []
+        for pnode in pattern.traverse("preorder"):
+            node = CompiledPatternNode(pnode, syntaxes, root_syntax, syntax_keys)
+            pnode2node[pnode] = node
+            if pnode is not pattern:
+                all_children[pnode2node[pnode.up]].append(node)
+            self.nodes.append(node)
+        self.root = pnode2node[pattern]
+
+        # Split the pattern by loose nodes into sub-patterns that can be used
+        # for strict matches
+        self.subpatterns = []
+        for node in self.nodes:
+            if node.loose_children:
+                for ch in all_children[node]:
+                    if not ch.loose_children:
+                        self.subpatterns.append(ch)
             else:
-                st = True
+                if node is self.root:
+                    self.subpatterns.append(node)
+                node.children = all_children[node]
+
+        # Calculate expected groupings of the split partitions
+        subpatterns = set(self.subpatterns)
+        content = {}
+        expected_groups = []
+        for node in reversed(self.nodes):
+            content[node] = set([node])
+            for ch in all_children[node]:
+                content[node].update(content[ch])
+            group = frozenset(content[node] & subpatterns)
+            if len(group) > 1 and group not in expected_groups:
+                expected_groups.append(group)
+        self.expected_groups = sorted(expected_groups, key=len)
+
+        # Nodes that need at least one match in the target tree for the
+        # pattern to match: the roots of all sub-patterns and their children
+        # with a minimum number of occurrences
+        self.required = []
+        to_visit = list(self.subpatterns)
+        while to_visit:
+            node = to_visit.pop()
+            self.required.append(node)
+            to_visit.extend(ch for ch in node.children if ch.min_occur > 0)
+
+        self.signature = PatternSignature(self)
+
+    def traverse(self):
+        """ Iterates over all nodes in the pattern (in preorder). """
+        return iter(self.nodes)
+
+    def get_scopes(self, cache):
+        """ Returns the scopes where the constraints of this pattern are
+        evaluated during a search: a dictionary of constraint scopes by the id
+        of the syntax controllers of this pattern. Scopes are built from new
+        copies of the syntax controllers with a TreePatternCache attached, so
+        searches running at the same time do not share them.
+
+        :param cache: the TreePatternCache of the target tree, used by the
+            syntax functions (leaves, species, n_leaves, etc.)
+        """
+        scopes = {}
+        for syntax in self.syntaxes:
+            search_syntax = copy(syntax)
+            if hasattr(search_syntax, 'cache'):
+                search_syntax.cache = cache
+            scopes[id(syntax)] = build_constraint_scope(search_syntax)
+        return scopes
+
+    def find_match(self, t, cache=None, stats=None, budget=None):
+        """ Iterate over all matches of this pattern in a tree.
+
+        :param t: the target tree
+        :param cache: optional TreePatternCache of the target tree, which can
+            be shared by many patterns searched in the same tree.
+        :param stats: optional SearchStats instance to profile the search.
+        :param budget: optional SearchBudget limiting the search.
+        """
+        return find_matches(t, self, cache, stats, budget)
 
-        except ValueError:
-            raise ValueError("not a boolean result: . Check quoted_node_names.")
+    def exists(self, t, cache=None, stats=None, budget=None):
+        """ Returns True if this pattern matches a tree, stopping the search at
+        the first match found. """
+        return pattern_exists(t, self, cache, stats, budget)
 
-        except (AttributeError, IndexError) as err:
-            raise ValueError('Constraint evaluation failed at %s: %s' %
-                             (target_node, err))
-        except NameError:
-            try:
-                # temporary fix. Can not access custom syntax on all nodes. Get it from the root node.
-                root_syntax = self.get_tree_root().syntax
-                constraint_scope = {attr_name: getattr(root_syntax, attr_name)
-                                    for attr_name in dir(root_syntax)}
-                constraint_scope.update({"__target_node": target_node})
+    def count(self, t, cache=None, stats=None, budget=None):
+        """ Returns the number of matches of this pattern in a tree. """
+        return count_matches(t, self, cache, stats, budget)
 
-                st = True
-                for constraint in constraints:
-                    if constraint:
-                        st &= eval(constraint, constraint_scope)
-                    else: st &= True
-                return st
-            except NameError as err:
-                raise NameError('Constraint evaluation failed at %s: %s' %
-                         (target_node, err))
+
+class PatternSignature(object):
+    def __init__(self, pattern):
+        """ Necessary conditions for a CompiledPattern to match a tree, which
+        can be checked against the summary of the tree kept by its
+        TreePatternCache without evaluating any constraint.
+
+        :param pattern: a CompiledPattern instance
+
+        The signature contains the names of the nodes that must be present
+        (plain names or `@.name == "..."` constraints), the species that must
+        be present (`contains_species` or `species` constraints) and the
+        minimum number of leaves of the tree.
+        """
+        self.names = set()
+        self.species = set()
+        node2min_leaves = {}
+        for node in pattern.required:
+            min_leaves = 0
+            for lookup in node.index_lookups:
+                if lookup[0] == 'eq' and lookup[1] == 'name':
+                    self.names.add(lookup[2])
+            # custom syntax controllers could redefine the syntax functions
+            if node.key[1] is PatternSyntax:
+                species, min_leaves = plan_syntax_requirements(node.constraint)
+                self.species.update(species)
+            node2min_leaves[node] = min_leaves
+
+        def get_min_leaves(node):
+            if node.terminal:
+                min_leaves = 1
+            else:
+                min_leaves = max(1, sum(ch.min_occur * get_min_leaves(ch)
+                                        for ch in node.children))
+            return max(min_leaves, node2min_leaves.get(node, 0))
+
+        self.min_leaves = max(get_min_leaves(node) for node in pattern.subpatterns)
+
+    def may_match(self, cache):
+        """ Returns False if the tree of a TreePatternCache does not fulfill the
+        conditions of this signature, so the pattern can not match it. """
+        if self.names:
+            index = cache.get_attr_index('name')
+            if index is not None and not all(name in index for name in self.names):
+                return False
+        if self.species and not cache.has_species(cache.tree, self.species):
+            return False
+        if (self.min_leaves > 1 and
+            len(cache.get_leaf_nodes()) < self.min_leaves):
+            return False
+        return True
+
+
+class PatternSet(object):
+    def __init__(self, patterns):
+        """ Groups many patterns to be searched together. Identical constraints
+        across patterns are evaluated only once per target tree.
+
+        :param patterns: a list of TreePattern or CompiledPattern instances
+        """
+        self.patterns = [p if isinstance(p, CompiledPattern) else CompiledPattern(p)
+                         for p in patterns]
+
+        # One representative node for every distinct constraint
+        self.key2node = OrderedDict()
+        for pattern in self.patterns:
+            for node in pattern.nodes:
+                self.key2node.setdefault(node.key, node)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def get_scopes(self, cache):
+        """ Returns the constraint scopes of a search of all patterns (see
+        CompiledPattern.get_scopes). """
+        scopes = {}
+        for pattern in self.patterns:
+            scopes.update(pattern.get_scopes(cache))
+        return scopes
+
+    def compute_match_matrix(self, tree, cache, patterns=None, stats=None,
+                             index=None, exceeded=None):
+        """ Computes a dictionary where keys are all the distinct constraints
+        in the set of patterns and values all nodes matching them. Constraints
+        that cannot be narrowed down by the cache indexes are evaluated in a
+        single traversal of the target tree.
+
+        :param patterns: if provided, only the constraints of these patterns
+            are computed.
+        :param stats: optional list with a SearchStats instance for every
+            pattern in the set. Constraints shared by several patterns are
+            accounted to the first one using them. Instances returned by
+            SearchBudget.start() limit the candidates of every pattern and
+            the evaluations accounted to it.
+        :param index: optional index of the nodes where constraints are
+            evaluated (by default, the cache, with all nodes in the tree).
+        :param exceeded: optional dictionary where the SearchBudgetExceeded
+            errors of the patterns exceeding their budget are stored by
+            pattern index. Their constraints are then accounted to the next
+            pattern using them, or no longer evaluated (with incomplete
+            results). If not provided, the errors are raised.
+        """
+        if patterns is None:
+            patterns = self.patterns
+        if exceeded is None:
+            exceeded = {}
+            raise_exceeded = True
         else:
-            return st
+            raise_exceeded = False
+
+        # indexes of the patterns using every constraint
+        key2owners = defaultdict(list)
+        for i, pattern in enumerate(self.patterns):
+            if pattern in patterns:
+                for key in set(node.key for node in pattern.nodes):
+                    key2owners[key].append(i)
+
+        def get_stats(i):
+            return stats[i] if stats is not None else None
+
+        def drop(i, error):
+            if raise_exceeded:
+                raise error
+            exceeded[i] = error
+
+        def charge(key, action):
+            # Calls action with the stats of the first pattern using a
+            # constraint within its budget. Returns False if there is none.
+            for i in key2owners[key]:
+                if i not in exceeded:
+                    try:
+                        action(get_stats(i))
+                        return True
+                    except SearchBudgetExceeded as e:
+                        drop(i, e)
+            return False
+
+        def budget_match(key, is_local_match):
+            def budget_local_match(tnode, cache):
+                found = []
+                charge(key, lambda pattern_stats: found.append(
+                    pattern_stats.counted(is_local_match)(tnode, cache)
+                    if pattern_stats is not None else is_local_match(tnode, cache)))
+                return found and found[0]
+            return budget_local_match
+
+        # syntax functions use the cache of the target tree
+        scopes = self.get_scopes(cache)
+
+        if index is None:
+            index = cache
+        key2nodes = {}
+        n_candidates = defaultdict(int)
+        leaf_scan, internal_scan = [], []
+        for key, node in six.iteritems(self.key2node):
+            if key not in key2owners:
+                continue
+            candidates, exact = node.find_candidates(index)
+            if not exact:
+                found = node.find_vectorized_matches(index)
+                if found is not None:
+                    candidates, exact = found, True
+
+            # every pattern counts the candidates of all its constraints, as
+            # find_matches does, before evaluating them
+            for i in key2owners[key]:
+                budget = getattr(get_stats(i), "budget", None)
+                if budget is not None and i not in exceeded:
+                    n_candidates[i] += len(candidates)
+                    try:
+                        budget.check_candidates(n_candidates[i])
+                    except SearchBudgetExceeded as e:
+                        drop(i, e)
+            if not charge(key, lambda pattern_stats: pattern_stats is not None and
+                          pattern_stats.add_candidates(node.constraint, len(candidates))):
+                key2nodes[key] = set()
+                continue
+            if exact:
+                key2nodes[key] = set(candidates)
+                continue
+
+            key2nodes[key] = set()
+            is_local_match = partial(node.is_local_match, scopes=scopes)
+            if stats is not None:
+                is_local_match = budget_match(key, is_local_match)
+            if candidates is index.get_leaf_nodes():
+                leaf_scan.append((key, is_local_match))
+            elif candidates is index.get_internal_nodes():
+                internal_scan.append((key, is_local_match))
+            else:
+                key2nodes[key].update(n for n in candidates
+                                      if is_local_match(n, cache))
+
+        if leaf_scan or internal_scan:
+            for tnode in index.get_nodes():
+                for key, is_local_match in (internal_scan if tnode.children else leaf_scan):
+                    if is_local_match(tnode, cache):
+                        key2nodes[key].add(tnode)
+        return key2nodes
+
+    def find_matches(self, tree, cache=None, stats=None, budget=None):
+        """ Iterate over all matches of all patterns in a tree.
+
+        :param tree: the target tree
+        :param cache: optional TreePatternCache of the target tree
+        :param stats: optional list with a SearchStats instance for every
+            pattern, to profile the search.
+        :param budget: optional SearchBudget limiting the search of every
+            pattern. A pattern exceeding it does not stop the search of the
+            others: SearchBudgetExceeded is raised once they are done.
+
+        :return: an iterator of (pattern index, match) tuples
+        """
+        exceeded = []
+        for i, matches in self._iter_searches(tree, cache, stats, budget):
+            try:
+                for match in matches:
+                    yield i, match
+            except SearchBudgetExceeded:
+                exceeded.append(i)
+        self._check_exceeded(exceeded)
+
+    def exists(self, tree, cache=None, stats=None, budget=None):
+        """ Returns a list of booleans indicating, for every pattern, if it
+        matches a tree. The search of each pattern stops at its first match. """
+        found = [False] * len(self.patterns)
+        exceeded = []
+        for i, matches in self._iter_searches(tree, cache, stats, budget):
+            try:
+                for match in matches:
+                    found[i] = True
+                    break
+            except SearchBudgetExceeded:
+                exceeded.append(i)
+        self._check_exceeded(exceeded, found)
+        return found
+
+    def count(self, tree, cache=None, stats=None, budget=None):
+        """ Returns a list with the number of matches of every pattern in a
+        tree. """
+        counts = [0] * len(self.patterns)
+        exceeded = []
+        for i, matches in self._iter_searches(tree, cache, stats, budget):
+            try:
+                counts[i] = sum(1 for match in matches)
+            except SearchBudgetExceeded:
+                exceeded.append(i)
+        self._check_exceeded(exceeded, counts)
+        return counts
+
+    def _check_exceeded(self, exceeded, results=None):
+        """ Raises SearchBudgetExceeded if the search of any pattern exceeded
+        its budget. """
+        if exceeded:
+            if results is not None:
+                results = [None if i in exceeded else result
+                           for i, result in enumerate(results)]
+            raise SearchBudgetExceeded(
+                "Search budget exceeded by pattern(s) %s" % ", ".join(map(str, exceeded)),
+                patterns=exceeded, results=results)
+
+    def _iter_searches(self, tree, cache, stats=None, budget=None):
+        """ Iterate over (pattern index, iterator of matches) tuples for all
+        patterns that could match a tree, skipping the ones whose signature
+        is not fulfilled by the tree or with a required node without
+        matches. """
+        if cache is None:
+            cache = TreePatternCache(tree)
+        elif cache.tree is not tree:
+            raise ValueError("The cache provided does not belong to the target tree")
+
+        if stats is None:
+            candidates = [(i, pattern) for i, pattern in enumerate(self.patterns)
+                          if pattern.signature.may_match(cache)]
+        else:
+            candidates = []
+            for i, pattern in enumerate(self.patterns):
+                stats[i].trees += 1
+                start = timer()
+                if pattern.signature.may_match(cache):
+                    candidates.append((i, pattern))
+                else:
+                    stats[i].rejected += 1
+                stats[i].times["signature"] += timer() - start
+        if not candidates:
+            return
+
+        # the budget of every pattern starts before computing the matrix, so
+        # it limits the evaluation of its constraints too
+        matrix_stats = stats
+        exceeded = None
+        if budget is not None:
+            matrix_stats = [None] * len(self.patterns)
+            for i, pattern in candidates:
+                matrix_stats[i] = budget.start()
+            exceeded = {}
+
+        start = timer()
+        key2nodes = self.compute_match_matrix(
+            tree, cache, [pattern for i, pattern in candidates], matrix_stats,
+            exceeded=exceeded)
+        if matrix_stats is not None:
+            # the shared matrix is accounted to the first pattern
+            matrix_stats[candidates[0][0]].times["match_matrix"] += timer() - start
+
+        for i, pattern in candidates:
+            pattern_stats = stats[i] if stats is not None else None
+            if budget is not None and i in exceeded:
+                yield i, _search_within_budget(
+                    budget, pattern_stats, lambda query_stats, e=exceeded[i]: _failed_search(e),
+                    matrix_stats[i])
+                continue
+            if not all(key2nodes[node.key] for node in pattern.required):
+                if stats is not None:
+                    stats[i].rejected += 1
+                    if budget is not None:
+                        stats[i].update(matrix_stats[i])
+                continue
+            c2nodes = defaultdict(set)
+            for node in pattern.nodes:
+                c2nodes[node.constraint] = key2nodes[node.key]
+            if budget is not None:
+                def search(query_stats, pattern=pattern, c2nodes=c2nodes):
+                    return query_stats.timed(_search(tree, pattern, c2nodes, cache,
+                                                     query_stats), "search")
+                matches = _search_within_budget(budget, pattern_stats, search,
+                                                matrix_stats[i])
+            else:
+                matches = _search(tree, pattern, c2nodes, cache, pattern_stats)
+                if pattern_stats is not None:
+                    matches = pattern_stats.timed(matches, "search")
+            yield i, matches
+
+
+
+class MatchSession(object):
+    def __init__(self, tree, patterns):
+        """ Keeps the matches of a set of standing patterns in a tree up to
+        date while the tree is edited (pruned, re-rooted, annotated, etc.).
+        The nodes matching every constraint and the children_match results
+        are kept between edits, so update() only evaluates the nodes edited
+        and their ancestors, instead of searching the whole tree again.
+
+        Constraints are assumed to depend only on a node and its
+        descendants, as all the functions of PatternSyntax do. Constraints
+        looking at other parts of the tree (e.g., @.up) are not updated
+        when those change.
+
+        :param tree: the target tree. Its root node should not change.
+        :param patterns: a list of TreePattern or CompiledPattern instances,
+            or a PatternSet.
+        """
+        self.tree = tree
+        self.pattern_set = (patterns if isinstance(patterns, PatternSet)
+                            else PatternSet(patterns))
+        self.cache = TreePatternCache(tree)
+
+        # children of every node when last updated, to find removed nodes
+        self._children = dict((n, list(n.children)) for n in tree.traverse())
+        # (target node, pattern node) pairs verified by children_match
+        self._memo = {}
+
+        self._key2nodes = self.pattern_set.compute_match_matrix(tree, self.cache)
+
+        self._c2nodes = []
+        self._root_matches = {}
+        for pattern in self.pattern_set.patterns:
+            c2nodes = defaultdict(set)
+            for node in pattern.nodes:
+                c2nodes[node.constraint] = self._key2nodes[node.key]
+            self._c2nodes.append(c2nodes)
+            for proot in pattern.subpatterns:
+                self._root_matches[proot] = set(
+                    n for n in c2nodes[proot.constraint]
+                    if children_match(n, proot, c2nodes, memo=self._memo))
+
+        #: for every pattern, the set of nodes matching it
+        self.matches = [self._join(i) for i in range(len(self.pattern_set))]
+
+    def _join(self, i):
+        """ Returns the set of matches of a pattern, given the matches of its
+        sub-patterns. """
+        pattern = self.pattern_set.patterns[i]
+        root_matches = [self._root_matches[proot] for proot in pattern.subpatterns]
+        if len(root_matches) == 1:
+            return set(root_matches[0])
+        if not all(root_matches):
+            return set()
+        return set(join_loose_matches([list(m) for m in root_matches], pattern.subpatterns,
+                                      pattern.expected_groups, self.cache.get_lca_index()))
+
+    def _in_tree(self, node):
+        while node.up is not None:
+            node = node.up
+        return node is self.tree
+
+    def update(self, nodes):
+        """ Updates the matches of all patterns after some nodes of the tree
+        are edited.
+
+        :param nodes: the nodes whose attributes or children changed. For
+            instance, the parent of a node that was detached, pruned or
+            added, the nodes annotated or all the nodes whose children
+            changed after re-rooting. Nodes added to the tree and nodes
+            removed from it under those nodes are found automatically.
+
+        :return: a list with, for every pattern, a tuple with the set of
+            nodes that started matching it and the set of nodes that no
+            longer match it.
+        """
+        # the nodes edited, their ancestors and any node new in the tree
+        affected = set()
+        removed = set()
+        for node in nodes:
+            if not self._in_tree(node):
+                removed.add(node)
+                continue
+            while node is not None and node not in affected:
+                affected.add(node)
+                node = node.up
+        to_visit = list(affected)
+        while to_visit:
+            node = to_visit.pop()
+            for ch in node.children:
+                if ch not in self._children and ch not in affected:
+                    affected.add(ch)
+                    to_visit.append(ch)
+
+        # nodes no longer in the tree, with the descendants they had
+        for node in affected:
+            children = set(node.children)
+            removed.update(ch for ch in self._children.get(node, ())
+                           if ch not in children and not self._in_tree(ch))
+        to_visit = list(removed)
+        while to_visit:
+            node = to_visit.pop()
+            for ch in self._children.pop(node, ()):
+                # children moved elsewhere may still be in the tree
+                if ch not in removed and (ch.up is node or not self._in_tree(ch)):
+                    removed.add(ch)
+                    to_visit.append(ch)
+        # common ancestors (of loose connections) only change with the topology
+        restructured = bool(removed)
+        for node in affected:
+            restructured |= self._children.get(node) != node.children
+            self._children[node] = list(node.children)
+
+        # affected nodes sorted so that children come before their parents
+        postorder = []
+        if affected:
+            to_visit = [self.tree]
+            while to_visit:
+                node = to_visit.pop()
+                postorder.append(node)
+                to_visit.extend(ch for ch in node.children if ch in affected)
+            postorder.reverse()
+        self.cache.update(postorder, removed)
+
+        changed = affected | removed
+        pattern_nodes = [node for pattern in self.pattern_set.patterns
+                         for node in pattern.nodes]
+        for node in changed:
+            for pnode in pattern_nodes:
+                self._memo.pop((node, pnode), None)
+
+        key2nodes = self.pattern_set.compute_match_matrix(
+            self.tree, self.cache, index=_NodeSubset(affected))
+        for key, key_nodes in six.iteritems(self._key2nodes):
+            key_nodes.difference_update(changed)
+            key_nodes.update(key2nodes[key])
+
+        changes = []
+        for i, pattern in enumerate(self.pattern_set.patterns):
+            c2nodes = self._c2nodes[i]
+            outdated = restructured
+            for proot in pattern.subpatterns:
+                root_matches = self._root_matches[proot]
+                old_matches = root_matches & changed
+                new_matches = set(n for n in affected if n in c2nodes[proot.constraint]
+                                  and children_match(n, proot, c2nodes, memo=self._memo))
+                root_matches.difference_update(old_matches)
+                root_matches.update(new_matches)
+                outdated |= old_matches != new_matches
+            if not outdated:
+                changes.append((set(), set()))
+                continue
+            matches = self._join(i)
+            changes.append((matches - self.matches[i], self.matches[i] - matches))
+            self.matches[i] = matches
+        return changes
+
+
+class SearchStats(object):
+    def __init__(self, name=""):
+        """ Counters and wall times of the searches of a pattern, recorded
+        only when an instance is given to find_matches (or to the PatternSet
+        methods, one per pattern). The same instance can be used to search
+        many trees, so the counts are accumulated.
+
+        Constraint evaluations happen lazily during the search, so their time
+        is included in the "search" time too.
+        """
+        self.name = name
+        self.trees = 0          # target trees searched
+        self.rejected = 0       # trees discarded before searching them
+        self.matches = 0
+        self.evaluations = 0    # constraint evaluations on target nodes
+        self.candidates = defaultdict(int)  # candidate nodes per constraint
+        self.combinations = 0   # (target, pattern) nodes verified by children_match
+        self.products = 0       # partial combinations built by the loose join
+        self.lca_calls = 0
+        self.times = OrderedDict([("signature", 0.0), ("match_matrix", 0.0),
+                                  ("evaluation", 0.0), ("search", 0.0)])
+        # SearchBudget limiting the search, and its time limit
+        self.budget = None
+        self.deadline = None
+
+    def __str__(self):
+        printable = "{}\n".format(self.name) if self.name else ""
+        printable += "Trees searched: {} ({} rejected)\n".format(self.trees, self.rejected)
+        printable += "Matches: {}\n".format(self.matches)
+        printable += "Constraint evaluations: {}\n".format(self.evaluations)
+        for constraint, count in sorted(six.iteritems(self.candidates)):
+            printable += "Candidates of {}: {}\n".format(constraint, count)
+        printable += "Children combinations: {}\n".format(self.combinations)
+        printable += "Loose join products: {}\n".format(self.products)
+        printable += "LCA calls: {}\n".format(self.lca_calls)
+        for phase, elapsed in six.iteritems(self.times):
+            printable += "Time in {}: {:.6f}s\n".format(phase, elapsed)
+        return printable
+
+    def update(self, other):
+        """ Adds the counts and times of another SearchStats instance. """
+        for attr in ["trees", "rejected", "matches", "evaluations",
+                     "combinations", "products", "lca_calls"]:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        for constraint, count in six.iteritems(other.candidates):
+            self.candidates[constraint] += count
+        for phase, elapsed in six.iteritems(other.times):
+            self.times[phase] = self.times.get(phase, 0.0) + elapsed
+
+    def add_candidates(self, constraint, count):
+        self.candidates[constraint] += count
+        if self.budget is not None:
+            self.budget.check_candidates(sum(six.itervalues(self.candidates)))
+
+    def add_combinations(self, count=1):
+        self.combinations += count
+        if self.budget is not None:
+            self.budget.check(self)
+
+    def add_products(self, count=1):
+        self.products += count
+        if self.budget is not None:
+            self.budget.check(self)
+
+    def counted(self, is_local_match):
+        """ Wraps the is_local_match method of a pattern node to record its
+        evaluations. """
+        def counted_match(target_node, cache):
+            start = timer()
+            try:
+                return is_local_match(target_node, cache)
+            finally:
+                self.evaluations += 1
+                self.times["evaluation"] += timer() - start
+                if self.budget is not None:
+                    self.budget.check(self)
+        return counted_match
+
+    def timed(self, matches, phase):
+        """ Iterates over an iterator of matches, counting them and recording
+        the time spent producing them (but not consuming them). """
+        start = timer()
+        try:
+            for match in matches:
+                self.times[phase] += timer() - start
+                self.matches += 1
+                if self.budget is not None:
+                    self.budget.check(self)
+                yield match
+                start = timer()
+            self.times[phase] += timer() - start
+        finally:
+            # stopping early also stops the search
+            if hasattr(matches, "close"):
+                matches.close()
+
+
+class SearchBudgetExceeded(Exception):
+    def __init__(self, message, patterns=None, results=None):
+        """ Raised when the search of a pattern exceeds its SearchBudget.
+
+        :param patterns: with PatternSet, the indexes of the patterns that
+            exceeded the budget.
+        :param results: with PatternSet.exists() and count(), the results of
+            all patterns (None for the ones exceeding the budget).
+        """
+        super(SearchBudgetExceeded, self).__init__(message)
+        self.patterns = patterns
+        self.results = results
+
+
+class SearchBudget(object):
+    def __init__(self, max_time=None, max_combinations=None, max_candidates=None):
+        """ Limits of the search of a pattern in a tree, so a pathological
+        pattern or tree aborts with SearchBudgetExceeded instead of running
+        for hours. Limits are checked between the steps of the search (a
+        single constraint evaluation is never interrupted).
+
+        :param max_time: maximum wall time of the search, in seconds.
+        :param max_combinations: maximum number of children combinations
+            (target and pattern node pairs verified) plus partial combinations
+            built by the join of loose connections.
+        :param max_candidates: maximum number of candidate target nodes of all
+            the constraints of the pattern.
+        """
+        self.max_time = max_time
+        self.max_combinations = max_combinations
+        self.max_candidates = max_candidates
+
+    def start(self, name=""):
+        """ Returns a new SearchStats to record a search limited by this
+        budget, starting now. """
+        stats = SearchStats(name)
+        stats.budget = self
+        if self.max_time is not None:
+            stats.deadline = timer() + self.max_time
+        return stats
+
+    def check(self, stats):
+        if (self.max_combinations is not None and
+            stats.combinations + stats.products > self.max_combinations):
+            raise SearchBudgetExceeded("Search budget exceeded: more than %d combinations"
+                                       % self.max_combinations)
+        if stats.deadline is not None and timer() > stats.deadline:
+            raise SearchBudgetExceeded("Search budget exceeded: more than %gs"
+                                       % self.max_time)
+
+    def check_candidates(self, count):
+        if self.max_candidates is not None and count > self.max_candidates:
+            raise SearchBudgetExceeded("Search budget exceeded: more than %d candidates"
+                                       % self.max_candidates)
+
+
+def _search_within_budget(budget, stats, search, query_stats=None):
+    """ Iterates over the matches of a search limited by a budget.
+
+    :param search: a function returning the iterator of matches of a search
+        recorded in the SearchStats given as argument.
+    :param stats: optional SearchStats where the search is added when it ends.
+    :param query_stats: the SearchStats returned by budget.start() if the
+        search started before (e.g., computing the match matrix of a
+        PatternSet). By default, the budget starts now.
+    """
+    if query_stats is None:
+        query_stats = budget.start()
+    try:
+        for match in search(query_stats):
+            yield match
+    finally:
+        if stats is not None:
+            stats.update(query_stats)
+
 
-    def find_match(self, t):
-        return find_matches(t, self)
+def _failed_search(error):
+    """ Search that exceeded its budget before looking for any match. """
+    raise error
+    yield
 
 
+class _CountingMemo(dict):
+    """ Memo of children_match counting the (target, pattern) node pairs
+    verified in a SearchStats instance. """
+    def __init__(self, stats):
+        super(_CountingMemo, self).__init__()
+        self.stats = stats
+
+    def __setitem__(self, key, value):
+        super(_CountingMemo, self).__setitem__(key, value)
+        self.stats.add_combinations()
+
 
 # NEW APPROACH
-def compute_match_matrix(pattern, tree):
+def compute_match_matrix(pattern, tree, cache=None, stats=None):
     '''Computes a dictionary where keys are all the constraints observed in a
-    pattern and values all nodes matching those patterns.'''
+    pattern and values all nodes matching those patterns. Simple constraints
+    are resolved using the indexes of the tree cache, so the tree is only
+    scanned for constraints that require evaluation.'''
+
+    if cache is None:
+        cache = TreePatternCache(tree)
+    scopes = pattern.get_scopes(cache) if isinstance(pattern, CompiledPattern) else None
 
     c2nodes = defaultdict(set)
-    for n in tree.traverse():
-        for cn in pattern.traverse():
-            if cn.is_local_match(n, None):
-                c2nodes[cn.constraint].add(n)
+    for cn in pattern.traverse():
+        if cn.constraint not in c2nodes:
+            c2nodes[cn.constraint] = cn.find_local_matches(cache, stats, scopes)
     return c2nodes
 
-def children_match(tnode, pnode, c2nodes, loose_constraint=None):
+class LazyNodeSet(object):
+    def __init__(self, pnode, cache, stats=None, scopes=None):
+        """ The set of target nodes matching the constraint of a pattern node,
+        evaluated only for the nodes that are tested or iterated.
+
+        :param pnode: a pattern node (TreePattern or CompiledPatternNode)
+        :param cache: the TreePatternCache of the target tree
+        :param stats: optional SearchStats instance recording the candidates
+            and constraint evaluations.
+        :param scopes: the constraint scopes of the search (see
+            CompiledPattern.get_scopes).
+        """
+        self.pnode = pnode
+        self.cache = cache
+        self.candidates, self.exact = pnode.find_candidates(cache)
+        if not self.exact:
+            # constraints on node attributes are solved at once
+            found = pnode.find_vectorized_matches(cache)
+            if found is not None:
+                self.candidates, self.exact = found, True
+        self.is_local_match = partial(pnode.is_local_match, scopes=scopes)
+        if stats is not None:
+            stats.add_candidates(pnode.constraint, len(self.candidates))
+            self.is_local_match = stats.counted(self.is_local_match)
+        self._checked = {}
+
+    def __contains__(self, node):
+        if node not in self.candidates:
+            return False
+        if self.exact:
+            return True
+        is_match = self._checked.get(node)
+        if is_match is None:
+            is_match = self.is_local_match(node, self.cache)
+            self._checked[node] = is_match
+        return is_match
+
+    def __iter__(self):
+        for node in self.candidates:
+            if node in self:
+                yield node
+
+    def __len__(self):
+        return sum(1 for node in self)
+
+    def __bool__(self):
+        for node in self:
+            return True
+        return False
+    __nonzero__ = __bool__
+
+
+class LazyMatchMatrix(dict):
+    def __init__(self, pattern, cache, stats=None, scopes=None):
+        """ Dictionary where keys are all the constraints observed in a pattern
+        and values LazyNodeSet instances of the nodes matching them. Each
+        constraint is only evaluated on the target nodes reached during the
+        search, so stopping a search early does not pay for evaluating all
+        constraints on all nodes.
+
+        :param pattern: a TreePattern or CompiledPattern instance
+        :param cache: the TreePatternCache of the target tree
+        :param stats: optional SearchStats instance recording the constraint
+            evaluations.
+        :param scopes: the constraint scopes of the search (see
+            CompiledPattern.get_scopes).
+        """
+        super(LazyMatchMatrix, self).__init__()
+        self.cache = cache
+        self.stats = stats
+        self.scopes = scopes
+        self.constraint2node = {}
+        for node in pattern.traverse():
+            self.constraint2node.setdefault(node.constraint, node)
+
+    def __missing__(self, constraint):
+        nodes = LazyNodeSet(self.constraint2node[constraint], self.cache, self.stats,
+                            self.scopes)
+        self[constraint] = nodes
+        return nodes
+
+
+class _LazyList(object):
+    """ List of the items produced by an iterator, consumed only as far as
+    needed and which can be iterated any number of times. """
+
+    def __init__(self, iterator):
+        self._items = []
+        self._iterator = iterator
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self._items):
+                try:
+                    self._items.append(next(self._iterator))
+                except StopIteration:
+                    return
+            yield self._items[i]
+            i += 1
+
+
+def assign_children(options, min_occur, max_occur):
+    '''Solves the assignment of target children to pattern children as a
+    bipartite matching problem with capacities.
+
+    :param options: a list containing, for each target child, the list of
+        pattern children (as indexes) that it can be assigned to.
+    :param min_occur: minimum number of target children to be assigned to
+        each pattern child.
+    :param max_occur: maximum number of target children to be assigned to
+        each pattern child.
+
+    :return: True if every target child can be assigned to a single pattern
+        child, so that all pattern children receive between their min and max
+        number of nodes.
+    '''
+    n_pattern = len(min_occur)
+    owner = [None] * len(options)
+    assigned = [set() for _ in range(n_pattern)]
+    pattern_options = [[] for _ in range(n_pattern)]
+    for t, t_options in enumerate(options):
+        for p in t_options:
+            pattern_options[p].append(t)
+
+    def move(t, p):
+        if owner[t] is not None:
+            assigned[owner[t]].discard(t)
+        owner[t] = p
+        assigned[p].add(t)
+
+    def add_to_pattern(start):
+        # Augmenting path (BFS) from a pattern child to a free target child.
+        # Nodes already assigned to other pattern children can be exchanged,
+        # so the number of nodes in the rest of pattern children is kept.
+        reached_by = {}   # target child -> pattern child reaching it
+        released = {start: None}  # pattern child -> target child it releases
+        queue = [start]
+        for p in queue:
+            for t in pattern_options[p]:
+                if t in reached_by:
+                    continue
+                reached_by[t] = p
+                if owner[t] is None:
+                    while t is not None:
+                        p = reached_by[t]
+                        next_t = released[p]
+                        move(t, p)
+                        t = next_t
+                    return True
+                elif owner[t] not in released:
+                    released[owner[t]] = t
+                    queue.append(owner[t])
+        return False
+
+    def add_target(start):
+        # Augmenting path (BFS) from a free target child to a pattern child
+        # not yet full. Assignments in the path are shifted by one position.
+        reached_by = {start: None}  # target child -> pattern child releasing it
+        taken_from = {}  # pattern child -> target child it takes
+        queue = [start]
+        for t in queue:
+            for p in options[t]:
+                if p in taken_from:
+                    continue
+                taken_from[p] = t
+                if len(assigned[p]) < max_occur[p]:
+                    while p is not None:
+                        t = taken_from[p]
+                        next_p = reached_by[t]
+                        move(t, p)
+                        p = next_p
+                    return True
+                for t2 in assigned[p]:
+                    if t2 not in reached_by:
+                        reached_by[t2] = p
+                        queue.append(t2)
+        return False
+
+    # Satisfy first the minimum number of occurrences of every pattern
+    # child. Later augmentations never reduce the number of nodes assigned to
+    # a pattern child, so those lower bounds are kept.
+    for p in range(n_pattern):
+        for _ in range(min_occur[p]):
+            if not add_to_pattern(p):
+                return False
+
+    # And then, every target child should be consumed within max limits
+    for t in range(len(options)):
+        if owner[t] is None and not add_target(t):
+            return False
+    return True
+
+def children_match(tnode, pnode, c2nodes, loose_constraint=None, memo=None):
     '''returns True if a subtree (tnode) matches recursively a given pattern
     (pnode), handling min and max number of occurrences. pnode should not
     contain loose connections
+
+    If a memo dictionary is provided, results are stored on it for every
+    (tnode, pnode) pair visited, so each pair is only verified once, no
+    matter how many times it is reached during the same search.
     '''
 
     # If no children expected in pattern node, return True, as local
@@ -328,150 +2500,206 @@ def children_match(tnode, pnode, c2nodes, loose_constraint=None):
     if not pnode.children:
         return True
 
-    t_children = set(tnode.children)
+    if memo is not None:
+        key = (tnode, pnode)
+        if key not in memo:
+            memo[key] = _children_match(tnode, pnode, c2nodes, memo)
+        return memo[key]
+    return _children_match(tnode, pnode, c2nodes, memo)
+
+def _children_match(tnode, pnode, c2nodes, memo):
+    t_children = tnode.children
+    min_occur = [pnode_ch.min_occur for pnode_ch in pnode.children]
+    max_occur = [pnode_ch.max_occur for pnode_ch in pnode.children]
+    if sum(min_occur) > len(t_children) or sum(max_occur) < len(t_children):
+        return False
 
-    matches = []
-    matched_children = set()
-    constraint2max_occur = defaultdict(lambda: [set(), 0, 0])
-    for pnode_ch in pnode.children:
-        match_nodes = c2nodes[pnode_ch.constraint] & t_children
-        constraint2max_occur[pnode_ch.constraint][1] += pnode_ch.min_occur
-        constraint2max_occur[pnode_ch.constraint][2] += pnode_ch.max_occur
-        constraint2max_occur[pnode_ch.constraint][0].update(match_nodes)
+    # Find which pattern children could be matched by each target child,
+    # including their descendants
+    options = []
+    for tnode_ch in t_children:
+        tnode_ch_options = [i for i, pnode_ch in enumerate(pnode.children)
+                            if tnode_ch in c2nodes[pnode_ch.constraint] and
+                            children_match(tnode_ch, pnode_ch, c2nodes, memo=memo)]
 
-        # check min nodes each pattern constraint
-        if pnode_ch.min_occur > 0 and len(match_nodes) < pnode_ch.min_occur:
-            #print 1
+        # all target children should have a match
+        if not tnode_ch_options:
             return False
+        options.append(tnode_ch_options)
 
-        # Keep track all children nodes with matches
-        matched_children.update(match_nodes)
-
-        # And prepare all permutations of matches in node with minimum occurrences
-        if not match_nodes and pnode_ch.min_occur == 0:
-            matches.append([[None]])
-        else:
-            matches.append(list(itertools.permutations(match_nodes, max(pnode_ch.min_occur, 1))))
-
-    # there should be nodes without a match
-    if len(matched_children) < len(t_children):
-        #print 2
-        return False
-
-    # Let's check if there is a non-overlapping combination of nodes matches
+    # Let's check if there is a non-overlapping assignment of children
     # satisfying patterns. For instance, avoid cases where one node matches the
     # two required patterns
-    for comb in itertools.product(*matches):
-        valid = set()
-        potential_match = comb
-        for x in comb:
-            x = set(x)
-            inter = valid & set(x)
-            if not inter:
-                valid.update(x)
-            else:
-                potential_match = None
-                # let's check next comb
-                break
-
-        # Validate max number of occurrences assuming current valid combination
-        if potential_match:
-            for k, (matches, mino, maxo) in constraint2max_occur.items():
-                remain_match_nodes = matches - valid
-                if len(remain_match_nodes) > (maxo - mino):
-                    potential_match = None
-                    break
-
-        # Validate descendants
-        if potential_match:
-            match = True
-            # Let's check inside the node
-            for i, pnode_ch in enumerate(pnode.children):
-                for tnode_ch in potential_match[i]:
-                    if tnode_ch is None:
-                        continue
-                    if not children_match(tnode_ch, pnode_ch, c2nodes):
-                        match = False
-                        break
-                if not match:
-                    break
-            if match:
-                return True
+    return assign_children(options, min_occur, max_occur)
+
+def find_matches(tree, pattern, cache=None, stats=None, budget=None):
+    '''Iterate over all possible matches of pattern in tree
+
+    :param pattern: a TreePattern or, to avoid parsing it for every tree, a
+        CompiledPattern instance.
+    :param cache: a TreePatternCache instance of the target tree. If not
+        provided, a new one is created for this search. Reusing the same cache
+        to search many patterns in the same tree avoids rebuilding its content.
+    :param stats: optional SearchStats instance where the counts and times of
+        every phase of the search are recorded.
+    :param budget: optional SearchBudget limiting the time and size of the
+        search, which raises SearchBudgetExceeded when exceeded.
+    '''
+    if budget is not None:
+        search = lambda query_stats: find_matches(tree, pattern, cache, query_stats)
+        for match in _search_within_budget(budget, stats, search):
+            yield match
+        return
+
+    if cache is None:
+        cache = TreePatternCache(tree)
+    elif cache.tree is not tree:
+        raise ValueError("The cache provided does not belong to the target tree")
+
+    if not isinstance(pattern, CompiledPattern):
+        pattern = CompiledPattern(pattern)
+
+    if stats is not None:
+        stats.trees += 1
+        start = timer()
+
+    # reject trees lacking the names, species or leaves required by the
+    # pattern before evaluating any constraint
+    may_match = pattern.signature.may_match(cache)
+    if stats is not None:
+        stats.times["signature"] += timer() - start
+        if not may_match:
+            stats.rejected += 1
+    if not may_match:
+        return
+
+    # syntax functions (leaves, species, n_leaves, etc.) should use the
+    # cache of the target tree instead of traversing it again and again. It
+    # is attached to syntax controllers private to this search, so other
+    # searches of the same pattern can run at the same time.
+    scopes = pattern.get_scopes(cache)
+    start = timer()
+    c2nodes = LazyMatchMatrix(pattern, cache, stats, scopes)
+    # stop as soon as a node required for any match has no matches,
+    # starting with the ones resolved from indexes
+    required = sorted(pattern.required, key=lambda cn: not cn.exact_lookups)
+    has_required = all(c2nodes[cn.constraint] for cn in required)
+    if stats is not None:
+        stats.times["match_matrix"] += timer() - start
+        if not has_required:
+            stats.rejected += 1
+    if has_required:
+        matches = _search(tree, pattern, c2nodes, cache, stats)
+        if stats is not None:
+            matches = stats.timed(matches, "search")
+        for match in matches:
+            yield match
 
-    #print 3
+def pattern_exists(tree, pattern, cache=None, stats=None, budget=None):
+    '''Returns True if pattern matches tree. The search stops as soon as a
+    required pattern node has no matches in the tree or a first match is
+    found.'''
+    for match in find_matches(tree, pattern, cache, stats, budget):
+        return True
     return False
 
-def split_by_loose_nodes(pattern):
-    '''split a pattern tree into all subpatterns connected through loose connections
-    (allowing multiple intermediate between them). '''
-
-    pnode2content = pattern.get_cached_content(leaves_only=False)
-
-    # split pattern by loose nodes and store a list of partitions that can be
-    # used for strict matches
-    to_visit = set()
-    for n in list(pattern.traverse()):
-        if n.loose_children:
-            for ch in n.get_children():
-                if not ch.loose_children:
-                    to_visit.add(ch.detach())
-                else:
-                    ch.detach()
-        elif n is pattern:
-            to_visit.add(pattern)
-
-    # Calculate expected groupings of the split partitions
-    expected_groups = set()
-    for p, content in six.iteritems(pnode2content):
-        c = frozenset(content & to_visit)
-        if len(c) > 1:
-            expected_groups.add(c)
+def count_matches(tree, pattern, cache=None, stats=None, budget=None):
+    '''Returns the number of matches of pattern in tree.'''
+    return sum(1 for match in find_matches(tree, pattern, cache, stats, budget))
 
-    return to_visit, sorted(expected_groups, key=lambda x: len(x))
+def _search(tree, pattern, c2nodes, cache=None, stats=None):
+    '''Iterate over all matches of a compiled pattern in tree, given the nodes
+    matching each of its constraints. Matches are reported as soon as they are
+    verified.'''
+    # (tnode, pnode) pairs already verified during this search
+    memo = {} if stats is None else _CountingMemo(stats)
 
-
-def find_matches(tree, pattern):
-    '''Iterate over all possible matches of pattern in tree'''
-    pattern = deepcopy(pattern)
-    for n in pattern.traverse():
-        n.init_controller()
-
-    c2nodes = compute_match_matrix(pattern, tree)
-    root2matches = OrderedDict()
-    to_visit, expected_groups = split_by_loose_nodes(pattern)
-
-    for proot in to_visit:
-        matches = []
+    def iter_root_matches(proot):
         for match_node in c2nodes[proot.constraint]:
-            if children_match(match_node, proot, c2nodes):
-                matches.append(match_node)
-        if not matches:
-            raise StopIteration
+            if children_match(match_node, proot, c2nodes, memo=memo):
+                yield match_node
+
+    if len(pattern.subpatterns) == 1:
+        for match_node in iter_root_matches(pattern.subpatterns[0]):
+            yield match_node
+        return
+
+    # The matches of each sub-pattern are found as the join needs them, but
+    # all sub-patterns need at least one
+    root_matches = []
+    for proot in pattern.subpatterns:
+        matches = _LazyList(iter_root_matches(proot))
+        for match_node in matches:
+            break
+        else:
+            return
+        root_matches.append(matches)
+
+    lca_index = cache.get_lca_index() if cache is not None else LCAIndex(tree)
+    for match in join_loose_matches(root_matches, pattern.subpatterns,
+                                    pattern.expected_groups, lca_index, stats):
+        yield match
+
+def join_loose_matches(matches, subpatterns, expected_groups, lca_index,
+                       stats=None):
+    '''Iterate over the matches of a pattern split by loose connections, given
+    the matches of each of its sub-patterns.
+
+    A combination of distinct sub-pattern matches is a match if the common
+    ancestors of all the expected groups of sub-patterns are different nodes,
+    and the common ancestor of the largest group (all sub-patterns) is
+    reported. Combinations are built one sub-pattern at a time, and each group
+    is checked as soon as all its sub-patterns have a node, so all the
+    combinations sharing a failing prefix are discarded at once. Matches are
+    reported in the order of the Cartesian product of the sub-pattern matches.
+
+    :param matches: a list with the matches of every sub-pattern
+    :param subpatterns: the list of sub-pattern roots
+    :param expected_groups: the groups of sub-patterns, sorted by size
+    :param lca_index: the LCAIndex of the target tree
+    :param stats: optional SearchStats instance counting the partial
+        combinations built and the common ancestors computed.
+    '''
+    p2index = dict((p, i) for i, p in enumerate(subpatterns))
 
-        root2matches[proot]=matches
+    # groups that can be checked once a node is chosen for each sub-pattern
+    completed_groups = [[] for _ in subpatterns]
+    for group in expected_groups:
+        members = sorted(p2index[p] for p in group)
+        completed_groups[members[-1]].append(members)
 
-    if len(root2matches) == 1:
-        for match in root2matches[proot]:
-            yield match
-        raise StopIteration
+    nodes = []
+    ancestors = []
 
-    p2index = {p:i for i,p in enumerate(root2matches.keys())}
-    to_visit = set(to_visit)
-    for nodes in itertools.product(*root2matches.values()):
-        ancestors = list()
-        if len(nodes) != len(set(nodes)):
-            continue
-        is_match = True
-        for group in expected_groups:
-            observed_group = [nodes[p2index[v]] for v in group]
-            anc = tree.get_common_ancestor(observed_group)
-            if anc not in ancestors:
-                ancestors.append(anc)
-            else:
-                is_match = False
-                break
-        if is_match:
+    def extend():
+        k = len(nodes)
+        if k == len(subpatterns):
+            # the largest group is always the last one checked
             yield ancestors[-1]
+            return
+        for node in matches[k]:
+            if node in nodes:
+                continue
+            nodes.append(node)
+            n_ancestors = len(ancestors)
+            is_match = True
+            if stats is not None:
+                stats.add_products()
+            for members in completed_groups[k]:
+                if stats is not None:
+                    stats.lca_calls += 1
+                anc = lca_index.get_common_ancestor([nodes[i] for i in members])
+                if anc in ancestors:
+                    is_match = False
+                    break
+                ancestors.append(anc)
+            if is_match:
+                for match in extend():
+                    yield match
+            del ancestors[n_ancestors:]
+            nodes.pop()
+
+    return extend()
 
 def expand_loose_connection_aliases(nw):
     def find_first_unmatched_closing_par(string):
@@ -542,7 +2770,8 @@ def expand_loose_connection_aliases(nw):
 #  A1) finding matches of the strict pattern expressions (no looses connections contained).
 #
 #  A1.1) The original pattern is split into pieces (sub-patterns) that contain
-#  no loose connections. This is mostly done by the `split_by_loose_nodes()` function
+#  no loose connections. This is done when the pattern is compiled (see
+#  `CompiledPattern`)
 #
 #  A1.2) Each sub-pattern is treated individually and used as input for A2.
 #